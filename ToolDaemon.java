@@ -0,0 +1,238 @@
+import java.io.BufferedReader;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.nio.file.Files;
+import java.nio.file.Path;
+import java.nio.file.Paths;
+import java.nio.file.StandardCopyOption;
+import java.security.MessageDigest;
+import java.security.Permission;
+import java.util.HashMap;
+import java.util.Map;
+import java.util.concurrent.atomic.AtomicInteger;
+import java.util.jar.JarFile;
+
+/**
+ * Long-lived JVM that runs apktool and apksigner for Kiridroid (see tooldaemon.py).
+ *
+ * Started as a single-file source program:
+ *   java -Djava.security.manager=allow ToolDaemon.java PORT_FILE IDLE_SECONDS
+ *
+ * The auth token arrives as the first line on stdin, so it never shows up in
+ * the process list.
+ *
+ * Every request on the loopback socket is: token, command, argument count and
+ * arguments, each string sent as a big-endian int length plus UTF-8 bytes.
+ * Commands are "ping", "shutdown" and "run" (arguments: jar path, then the
+ * tool's own arguments). The reply is the exit code followed by the captured
+ * stdout and stderr. Tool runs are serialised because System.out is global;
+ * tooldaemon.py starts one daemon per concurrent caller instead of queueing here.
+ */
+public class ToolDaemon {
+    static final class ExitTrap extends SecurityException {
+        final int status;
+
+        ExitTrap(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    static final Map<String, Method> MAINS = new HashMap<>();
+    static final Object RUN_LOCK = new Object();
+    static final AtomicInteger ACTIVE = new AtomicInteger();
+    static volatile long lastUsed = System.currentTimeMillis();
+    static volatile boolean stopping;
+
+    public static void main(String[] args) throws Exception {
+        Path portFile = Paths.get(args[0]);
+        long idleMillis = Long.parseLong(args[1]) * 1000L;
+        String tokenLine = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8)).readLine();
+        if (tokenLine == null || tokenLine.isEmpty()) {
+            throw new IOException("no token on stdin");
+        }
+        byte[] token = tokenLine.getBytes(StandardCharsets.UTF_8);
+
+        // The tools call System.exit when they finish or fail; turn that into
+        // an exit code instead of losing the daemon. Our own exits go through stop().
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkExit(int status) {
+                if (!stopping) {
+                    throw new ExitTrap(status);
+                }
+            }
+
+            @Override
+            public void checkPermission(Permission perm) {
+            }
+
+            @Override
+            public void checkPermission(Permission perm, Object context) {
+            }
+        });
+
+        ServerSocket server = new ServerSocket(0, 50, InetAddress.getLoopbackAddress());
+        Path tmp = portFile.resolveSibling(portFile.getFileName() + ".tmp");
+        Files.write(tmp, (server.getLocalPort() + "\n" + ProcessHandle.current().pid() + "\n")
+                .getBytes(StandardCharsets.UTF_8));
+        Files.move(tmp, portFile, StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE);
+
+        Thread idle = new Thread(() -> {
+            while (true) {
+                try {
+                    Thread.sleep(1000);
+                } catch (InterruptedException e) {
+                    return;
+                }
+                if (ACTIVE.get() == 0 && System.currentTimeMillis() - lastUsed > idleMillis) {
+                    stop();
+                }
+            }
+        }, "idle-shutdown");
+        idle.setDaemon(true);
+        idle.start();
+
+        while (true) {
+            Socket socket = server.accept();
+            Thread worker = new Thread(() -> serve(socket, token), "request");
+            worker.setDaemon(true);
+            worker.start();
+        }
+    }
+
+    static void stop() {
+        // System.exit, not halt: shutdown hooks must run so apktool's deleteOnExit
+        // temp files (its aapt binaries) are removed and the AppCDS archive is written.
+        stopping = true;
+        System.exit(0);
+    }
+
+    static void serve(Socket socket, byte[] token) {
+        ACTIVE.incrementAndGet();
+        try (Socket s = socket) {
+            DataInputStream in = new DataInputStream(s.getInputStream());
+            DataOutputStream out = new DataOutputStream(s.getOutputStream());
+            if (!MessageDigest.isEqual(readBytes(in), token)) {
+                return;
+            }
+            String command = readString(in);
+            String[] argv = new String[in.readInt()];
+            for (int i = 0; i < argv.length; i++) {
+                argv[i] = readString(in);
+            }
+            switch (command) {
+                case "ping":
+                    reply(out, 0, ("ok " + ProcessHandle.current().pid()).getBytes(StandardCharsets.UTF_8), new byte[0]);
+                    break;
+                case "shutdown":
+                    reply(out, 0, new byte[0], new byte[0]);
+                    stop();
+                    break;
+                case "run":
+                    run(out, argv);
+                    break;
+                default:
+                    reply(out, 2, new byte[0], ("unknown command " + command).getBytes(StandardCharsets.UTF_8));
+            }
+        } catch (IOException e) {
+            // Client went away; nothing to report to.
+        } finally {
+            lastUsed = System.currentTimeMillis();
+            ACTIVE.decrementAndGet();
+        }
+    }
+
+    static void run(DataOutputStream out, String[] argv) throws IOException {
+        ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+        ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+        int code = 0;
+        synchronized (RUN_LOCK) {
+            PrintStream oldOut = System.out;
+            PrintStream oldErr = System.err;
+            PrintStream toolOut = new PrintStream(stdout, true, StandardCharsets.UTF_8);
+            PrintStream toolErr = new PrintStream(stderr, true, StandardCharsets.UTF_8);
+            System.setOut(toolOut);
+            System.setErr(toolErr);
+            Thread current = Thread.currentThread();
+            ClassLoader oldLoader = current.getContextClassLoader();
+            try {
+                Method main = mainOf(argv[0]);
+                current.setContextClassLoader(main.getDeclaringClass().getClassLoader());
+                String[] toolArgs = new String[argv.length - 1];
+                System.arraycopy(argv, 1, toolArgs, 0, toolArgs.length);
+                main.invoke(null, (Object) toolArgs);
+            } catch (InvocationTargetException e) {
+                Throwable cause = e.getCause();
+                if (cause instanceof ExitTrap) {
+                    code = ((ExitTrap) cause).status;
+                } else {
+                    cause.printStackTrace(toolErr);
+                    code = 1;
+                }
+            } catch (ExitTrap e) {
+                code = e.status;
+            } catch (Exception e) {
+                e.printStackTrace(toolErr);
+                code = 1;
+            } finally {
+                toolOut.flush();
+                toolErr.flush();
+                System.setOut(oldOut);
+                System.setErr(oldErr);
+                current.setContextClassLoader(oldLoader);
+            }
+        }
+        reply(out, code, stdout.toByteArray(), stderr.toByteArray());
+    }
+
+    static Method mainOf(String jar) throws Exception {
+        Method main = MAINS.get(jar);
+        if (main == null) {
+            String mainClass;
+            try (JarFile jf = new JarFile(jar)) {
+                mainClass = jf.getManifest().getMainAttributes().getValue("Main-Class");
+            }
+            URLClassLoader loader = new URLClassLoader(new URL[] {Paths.get(jar).toUri().toURL()},
+                    ClassLoader.getPlatformClassLoader());
+            main = Class.forName(mainClass, true, loader).getMethod("main", String[].class);
+            MAINS.put(jar, main);
+        }
+        return main;
+    }
+
+    static byte[] readBytes(DataInputStream in) throws IOException {
+        int n = in.readInt();
+        if (n < 0 || n > (1 << 20)) {
+            throw new IOException("bad length " + n);
+        }
+        byte[] data = new byte[n];
+        in.readFully(data);
+        return data;
+    }
+
+    static String readString(DataInputStream in) throws IOException {
+        return new String(readBytes(in), StandardCharsets.UTF_8);
+    }
+
+    static void reply(DataOutputStream out, int code, byte[] stdout, byte[] stderr) throws IOException {
+        out.writeInt(code);
+        out.writeInt(stdout.length);
+        out.write(stdout);
+        out.writeInt(stderr.length);
+        out.write(stderr);
+        out.flush();
+    }
+}
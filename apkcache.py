@@ -0,0 +1,377 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+import apkzip
+import fastcopy
+import memplan
+import tooldaemon
+
+CACHE_DIR = os.path.abspath("cache")
+DECODE_CACHE_DIR = os.path.join(CACHE_DIR, "decoded")
+FRAMEWORK_CACHE_DIR = os.path.join(CACHE_DIR, "framework")
+# apktool writes this resource out as <frame-path>/1.apk the first time it needs
+# the Android framework; extracting it once lets every job start with a link.
+FRAMEWORK_RESOURCE = "brut/androlib/android-framework.jar"
+FRAMEWORK_APK = "1.apk"
+OVERLAY_CACHE_DIR = os.path.join(CACHE_DIR, "overlay")
+# Overlay bundles kept besides the one in use; older ones are deleted.
+OVERLAY_KEEP = 4
+WORKSPACE_DIR = os.path.join(CACHE_DIR, "workspaces")
+# Space the workspaces may take beyond the decode cache they link to, and
+# how long an unused one is kept.
+WORKSPACE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+WORKSPACE_MAX_AGE = 14 * 24 * 3600
+
+# Files the build edits in place after decoding. They are copied into the job
+# tree instead of hardlinked, so writes never reach the shared cache entry.
+MUTABLE_FILES = ("AndroidManifest.xml", "apktool.yml")
+MUTABLE_NAMES = ("ic_launcher.png",)
+
+# Keep classes*.dex raw instead of round-tripping them through smali; apktool
+# then copies the original DEX files into the rebuilt APK untouched.
+DECODE_NO_SOURCES = ("-s",)
+
+_digest_memo = {}
+
+def file_sha256(path):
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if memo_key in _digest_memo:
+        return _digest_memo[memo_key]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    _digest_memo[memo_key] = digest
+    return digest
+
+def apktool_version(apktool_jar):
+    # Read the version from the jar itself so no JVM is needed to build the key.
+    try:
+        with zipfile.ZipFile(apktool_jar) as zf:
+            for name in ("apktool.properties", "properties/apktool.properties"):
+                if name in zf.namelist():
+                    for line in zf.read(name).decode("utf-8", errors="ignore").splitlines():
+                        if line.startswith("application.version="):
+                            return line.split("=", 1)[1].strip()
+    except (OSError, zipfile.BadZipFile):
+        pass
+    return "sha256-" + file_sha256(apktool_jar)[:16]
+
+def decode_cache_key(base_apk, apktool_jar, decode_args=()):
+    h = hashlib.sha256()
+    h.update(file_sha256(base_apk).encode("ascii"))
+    h.update(b"\0" + apktool_version(apktool_jar).encode("utf-8"))
+    h.update(b"\0" + " ".join(decode_args).encode("utf-8"))
+    return h.hexdigest()[:40]
+
+def _is_mutable(rel_path):
+    rel_path = rel_path.replace(os.sep, "/")
+    return rel_path in MUTABLE_FILES or os.path.basename(rel_path) in MUTABLE_NAMES
+
+def clone_tree(src_dir, dst_dir):
+    stats = fastcopy.CopyStats()
+    for root, dirs, files in os.walk(src_dir):
+        rel_root = os.path.relpath(root, src_dir)
+        target_root = dst_dir if rel_root == "." else os.path.join(dst_dir, rel_root)
+        os.makedirs(target_root, exist_ok=True)
+        for fname in files:
+            src = os.path.join(root, fname)
+            dst = os.path.join(target_root, fname)
+            allow_link = not _is_mutable(os.path.normpath(os.path.join(rel_root, fname)))
+            fastcopy.copy_file(src, dst, allow_link, stats)
+    return stats
+
+def overlay_key(base_apk, native_libs, lib_compress):
+    h = hashlib.sha256()
+    h.update(file_sha256(base_apk).encode("ascii"))
+    h.update(b"\0" + apkzip.LAYOUT_VERSION.encode("utf-8"))
+    for abi, lib in sorted(native_libs.items()):
+        compress = lib_compress.get(f"lib/{abi}", zipfile.ZIP_DEFLATED)
+        h.update(f"\0{abi}:{file_sha256(lib)}:{compress}".encode("utf-8"))
+    return h.hexdigest()[:40]
+
+def overlay_bundle(base_apk, native_libs, lib_compress):
+    """Path of the overlay bundle (DEX + libc++, see apkzip.build_overlay), built on first use.
+
+    The file is never rewritten once published, so its entries keep the same
+    content_id and the signing caches keep matching.
+    """
+    key = overlay_key(base_apk, native_libs, lib_compress)
+    path = os.path.join(OVERLAY_CACHE_DIR, key + ".zip")
+    if os.path.exists(path):
+        logging.info(f"Overlay bundle cache hit ({key})")
+        return path
+    os.makedirs(OVERLAY_CACHE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=key + ".", suffix=".tmp", dir=OVERLAY_CACHE_DIR)
+    os.close(fd)
+    try:
+        entries = apkzip.build_overlay(tmp, base_apk, native_libs, lib_compress)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    logging.info(f"Overlay bundle cache miss ({key}): built {len(entries)} entries")
+    bundles = sorted((os.path.join(OVERLAY_CACHE_DIR, name) for name in os.listdir(OVERLAY_CACHE_DIR)
+                      if name.endswith(".zip") and name != key + ".zip"), key=os.path.getmtime, reverse=True)
+    for old in bundles[OVERLAY_KEEP:]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+    return path
+
+def _framework_seed(apktool_jar):
+    """Directory holding the framework shipped inside apktool_jar, or None if the jar has none."""
+    seed = os.path.join(FRAMEWORK_CACHE_DIR, apktool_version(apktool_jar))
+    if os.path.exists(os.path.join(seed, FRAMEWORK_APK)):
+        return seed
+    os.makedirs(seed, exist_ok=True)
+    try:
+        with zipfile.ZipFile(apktool_jar) as zf:
+            if FRAMEWORK_RESOURCE not in zf.namelist():
+                return None
+            fd, tmp = tempfile.mkstemp(dir=seed, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as out, zf.open(FRAMEWORK_RESOURCE) as src:
+                    shutil.copyfileobj(src, out)
+                os.replace(tmp, os.path.join(seed, FRAMEWORK_APK))
+            except BaseException:
+                os.remove(tmp)
+                raise
+    except (OSError, zipfile.BadZipFile) as e:
+        logging.warning(f"Could not pre-install the apktool framework: {e}")
+        return None
+    return seed
+
+def job_framework(apktool_jar, job_dir):
+    """Create job_dir/framework for apktool --frame-path, seeded by hardlink.
+
+    apktool otherwise shares one framework folder per user, and parallel
+    builds race on installing into it.
+    """
+    frame_dir = os.path.join(job_dir, "framework")
+    os.makedirs(frame_dir, exist_ok=True)
+    seed = _framework_seed(apktool_jar)
+    if seed is not None:
+        # apktool only reads 1.apk once it exists, so a link is safe.
+        fastcopy.copy_file(os.path.join(seed, FRAMEWORK_APK), os.path.join(frame_dir, FRAMEWORK_APK))
+    return frame_dir
+
+def apktool_job_args(frame_dir=None, jobs=None):
+    """apktool options that only affect how a run is done, not its output."""
+    args = []
+    if frame_dir is not None:
+        args += ["--frame-path", frame_dir]
+    if jobs is not None:
+        args += ["-j", str(jobs)]
+    return args
+
+def _run_decode(java_bin, apktool_jar, base_apk, out_dir, decode_args, job_args, env):
+    base_size = os.path.getsize(base_apk)
+    heap = memplan.heap_args(memplan.APKTOOL_DECODE, base_size)
+    cmd = [java_bin, *heap, "-jar", apktool_jar, "d", "-f", *job_args, *decode_args, base_apk, "-o", out_dir]
+    logging.info(f"Decompile command: {' '.join(cmd)}")
+    result = tooldaemon.run_java(cmd, kind=memplan.APKTOOL_DECODE, input_bytes=base_size, env=env)
+    logging.info(f"Decompile output: {result.stdout}\nError: {result.stderr}")
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+
+def decode_base_apk(java_bin, apktool_jar, base_apk, dest_dir, decode_args=(), job_args=(), env=None):
+    """Fill dest_dir with the apktool-decoded base APK, decoding only on a cache miss.
+
+    job_args (see apktool_job_args) are passed to apktool but are not part
+    of the cache key; env is the environment apktool runs with. Returns
+    True when the tree came from the cache.
+    """
+    key = decode_cache_key(base_apk, apktool_jar, decode_args)
+    entry = os.path.join(DECODE_CACHE_DIR, key)
+    hit = os.path.isdir(entry)
+    if not hit:
+        os.makedirs(DECODE_CACHE_DIR, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=key + ".", dir=DECODE_CACHE_DIR)
+        try:
+            tree = os.path.join(staging, "tree")
+            _run_decode(java_bin, apktool_jar, base_apk, tree, decode_args, job_args, env)
+            with open(entry + ".json", "w", encoding="utf-8") as f:
+                json.dump({
+                    "base_apk": os.path.basename(base_apk),
+                    "base_apk_sha256": file_sha256(base_apk),
+                    "apktool_version": apktool_version(apktool_jar),
+                    "decode_args": list(decode_args),
+                }, f, indent=2)
+            try:
+                os.rename(tree, entry)
+            except OSError:
+                # Another build published the same key first; use theirs.
+                if not os.path.isdir(entry):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    stats = clone_tree(entry, dest_dir)
+    stats.log(f"Decode cache {'hit' if hit else 'miss'} ({key})")
+    return hit
+
+def _own_bytes(path):
+    """Bytes under path not shared by hardlink with the decode cache."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            try:
+                st = os.stat(os.path.join(root, fname))
+            except OSError:
+                continue
+            if st.st_nlink == 1:
+                total += st.st_size
+    return total
+
+def _lock_owner(lock_path):
+    try:
+        with open(lock_path, encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+class Workspace:
+    """Decoded tree kept between builds of one (base APK, package name) pair.
+
+    apktool b keeps its build/ folder in the tree and skips the aapt stages
+    whose inputs are not newer than their outputs. reset() puts the files a
+    build edits back to the decoded state, and settle() gives every edited
+    file whose content matches the previous build its old mtime back, so a
+    build that only changes the label leaves the icons "unchanged".
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.tree = os.path.join(path, "tree")
+        self.meta = meta
+        self._lock = os.path.join(path, "lock")
+        self._state = os.path.join(path, "state.json")
+
+    @classmethod
+    def acquire(cls, base_apk, apktool_jar, package_name, decode_args=()):
+        """Lock and return the workspace, or None while another build uses it."""
+        decode_key = decode_cache_key(base_apk, apktool_jar, decode_args)
+        key = hashlib.sha256(f"{decode_key}\0{package_name}".encode("utf-8")).hexdigest()[:24]
+        path = os.path.join(WORKSPACE_DIR, key)
+        os.makedirs(path, exist_ok=True)
+        lock = os.path.join(path, "lock")
+        for _ in range(2):
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                owner = _lock_owner(lock)
+                if owner and memplan.pid_alive(owner):
+                    logging.info(f"Workspace {key} is in use by process {owner}; building in a temporary one")
+                    return None
+                os.remove(lock)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(str(os.getpid()))
+            break
+        else:
+            return None
+        meta = {"base_apk": os.path.basename(base_apk), "package": package_name,
+                "decode_key": decode_key, "decode_args": list(decode_args)}
+        return cls(path, meta)
+
+    def _mutable_files(self):
+        for root, dirs, files in os.walk(self.tree):
+            if root == self.tree and "build" in dirs:
+                dirs.remove("build")
+            for fname in files:
+                rel = os.path.relpath(os.path.join(root, fname), self.tree)
+                if _is_mutable(rel):
+                    yield rel
+
+    def reset(self):
+        """Restore the edited files from the decode cache; False when the tree must be decoded again."""
+        entry = os.path.join(DECODE_CACHE_DIR, self.meta["decode_key"])
+        if not (os.path.isdir(self.tree) and os.path.isdir(entry)):
+            shutil.rmtree(self.tree, ignore_errors=True)
+            return False
+        restored = 0
+        for rel in self._mutable_files():
+            pristine = os.path.join(entry, rel)
+            target = os.path.join(self.tree, rel)
+            if os.path.exists(pristine) and file_sha256(pristine) != file_sha256(target):
+                # Overwrite in place: replacing the file would touch the folder's mtime.
+                shutil.copyfile(pristine, target)
+                restored += 1
+        logging.info(f"Reusing workspace {os.path.basename(self.path)}; restored {restored} edited files")
+        return True
+
+    def settle(self):
+        """Call after the edits, before apktool b."""
+        try:
+            with open(self._state, encoding="utf-8") as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        state = {}
+        kept = 0
+        for rel in self._mutable_files():
+            target = os.path.join(self.tree, rel)
+            digest = file_sha256(target)
+            st = os.stat(target)
+            old = previous.get(rel)
+            if old is not None and old[0] == digest and old[1] != st.st_mtime_ns:
+                os.utime(target, ns=(st.st_atime_ns, old[1]))
+                kept += 1
+            state[rel] = [digest, os.stat(target).st_mtime_ns]
+        with open(self._state, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        logging.info(f"Workspace files unchanged since the last build: {kept} of {len(state)} edited files")
+
+    def release(self):
+        self.meta["last_used"] = time.time()
+        self.meta["bytes"] = _own_bytes(self.path)
+        with open(os.path.join(self.path, "workspace.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, indent=2)
+        try:
+            os.remove(self._lock)
+        except OSError:
+            pass
+        collect_workspaces(keep=self.path)
+
+def collect_workspaces(max_bytes=WORKSPACE_MAX_BYTES, max_age=WORKSPACE_MAX_AGE, keep=None):
+    """Delete workspaces unused for max_age, then the least recently used ones over max_bytes."""
+    if not os.path.isdir(WORKSPACE_DIR):
+        return
+    now = time.time()
+    candidates = []
+    total = 0
+    for name in os.listdir(WORKSPACE_DIR):
+        path = os.path.join(WORKSPACE_DIR, name)
+        owner = _lock_owner(os.path.join(path, "lock"))
+        if path == keep or (owner and memplan.pid_alive(owner)):
+            try:
+                with open(os.path.join(path, "workspace.json"), encoding="utf-8") as f:
+                    total += json.load(f).get("bytes", 0)
+            except (OSError, ValueError):
+                pass
+            continue
+        try:
+            with open(os.path.join(path, "workspace.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {"last_used": 0, "bytes": _own_bytes(path)}
+        candidates.append((meta.get("last_used", 0), meta.get("bytes", 0), path))
+        total += meta.get("bytes", 0)
+    candidates.sort()
+    for last_used, size, path in candidates:
+        if now - last_used > max_age or total > max_bytes:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logging.info(f"Removed workspace {os.path.basename(path)} ({size} bytes, "
+                         f"unused for {(now - last_used) / 86400:.1f} days)")
@@ -0,0 +1,578 @@
+"""In-process APK signing: v1 (JAR), v2 and v3, written into the APK in place."""
+import base64
+import bisect
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import apkcache
+import apkzip
+import axml
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    x509 = None
+
+CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = os.cpu_count() or 1
+# Digests of earlier builds (see DigestCache). Rows unused for this long are dropped.
+DIGEST_CACHE_PATH = os.path.join(apkcache.CACHE_DIR, "sign-digests.sqlite")
+DIGEST_CACHE_MAX_AGE = 30 * 24 * 3600
+
+SIGNING_BLOCK_MAGIC = b"APK Sig Block 42"
+V2_BLOCK_ID = 0x7109871A
+V3_BLOCK_ID = 0xF05368C0
+# Tells v2 verifiers that a v3 signature was stripped if it is missing.
+STRIPPING_PROTECTION_ATTR = 0xBEEFF00D
+V3_MIN_SDK = 28
+MAX_SDK = 0x7FFFFFFF
+# v1 signatures may use SHA-256 from API 18 on; older platforms need SHA-1.
+V1_SHA256_MIN_SDK = 18
+# Every platform from API 24 on verifies v2, so v1 is only written below it.
+V2_MIN_SDK = 24
+
+SIG_RSA_PKCS1_SHA256 = 0x0103
+SIG_ECDSA_SHA256 = 0x0201
+
+_JKS_MAGIC = 0xFEEDFEED
+_JKS_PRIVATE_KEY = 1
+_JKS_TRUSTED_CERT = 2
+_SUN_JKS_KEY_PROTECTOR = "1.3.6.1.4.1.42.2.17.1.1"
+
+class ApkSignError(Exception):
+    pass
+
+class ApkTooLargeError(ApkSignError):
+    """The signed APK would need zip64 records, which no APK signer or Android accepts."""
+
+def available():
+    return x509 is not None
+
+# --- DER --------------------------------------------------------------------
+
+def _der(tag, content):
+    n = len(content)
+    if n < 0x80:
+        length = bytes((n,))
+    else:
+        raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+        length = bytes((0x80 | len(raw),)) + raw
+    return bytes((tag,)) + length + content
+
+def _der_seq(*items):
+    return _der(0x30, b"".join(items))
+
+def _der_set(*items):
+    return _der(0x31, b"".join(sorted(items)))
+
+def _der_int(value):
+    return _der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+
+def _der_oid(oid):
+    parts = [int(p) for p in oid.split(".")]
+    body = bytearray((40 * parts[0] + parts[1],))
+    for part in parts[2:]:
+        chunk = [part & 0x7F]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7F))
+            part >>= 7
+        body += bytes(reversed(chunk))
+    return _der(0x06, bytes(body))
+
+def _der_read(data, pos):
+    """Return (tag, content start, content end) of the DER element at pos."""
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7F
+        length = int.from_bytes(data[pos:pos + count], "big")
+        pos += count
+    return tag, pos, pos + length
+
+def _der_oid_str(content):
+    parts = [content[0] // 40, content[0] % 40]
+    value = 0
+    for b in content[1:]:
+        value = (value << 7) | (b & 0x7F)
+        if not b & 0x80:
+            parts.append(value)
+            value = 0
+    return ".".join(map(str, parts))
+
+# --- keystores --------------------------------------------------------------
+
+class Signer:
+    def __init__(self, name, private_key, certificates):
+        self.name = name
+        self.private_key = private_key
+        self.certificates = certificates
+        self.certificate = x509.load_der_x509_certificate(certificates[0])
+        if isinstance(private_key, rsa.RSAPrivateKey):
+            self.algorithm = SIG_RSA_PKCS1_SHA256
+        elif isinstance(private_key, ec.EllipticCurvePrivateKey):
+            self.algorithm = SIG_ECDSA_SHA256
+        else:
+            raise ApkSignError(f"Unsupported key type: {type(private_key).__name__}")
+        self.public_key = private_key.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def sign(self, data, hash_algorithm=None):
+        hash_algorithm = hash_algorithm or hashes.SHA256()
+        if self.algorithm == SIG_RSA_PKCS1_SHA256:
+            return self.private_key.sign(data, padding.PKCS1v15(), hash_algorithm)
+        return self.private_key.sign(data, ec.ECDSA(hash_algorithm))
+
+def _java_utf(data, pos):
+    n = struct.unpack_from(">H", data, pos)[0]
+    return data[pos + 2:pos + 2 + n].decode("utf-8"), pos + 2 + n
+
+def _jks_decrypt_key(protected, password):
+    # Sun's JKS key protector: a SHA-1 keystream over the UTF-16 password.
+    _, start, end = _der_read(protected, 0)
+    _, alg_start, alg_end = _der_read(protected, start)
+    _, oid_start, oid_end = _der_read(protected, alg_start)
+    if _der_oid_str(protected[oid_start:oid_end]) != _SUN_JKS_KEY_PROTECTOR:
+        raise ApkSignError("Unsupported JKS key protection algorithm")
+    _, data_start, data_end = _der_read(protected, alg_end)
+    blob = protected[data_start:data_end]
+    salt, encrypted, check = blob[:20], blob[20:-20], blob[-20:]
+    password = password.encode("utf-16-be")
+    stream = bytearray()
+    digest = salt
+    while len(stream) < len(encrypted):
+        digest = hashlib.sha1(password + digest).digest()
+        stream += digest
+    key = bytes(a ^ b for a, b in zip(encrypted, stream))
+    if hashlib.sha1(password + key).digest() != check:
+        raise ApkSignError("Wrong key password")
+    return serialization.load_der_private_key(key, None)
+
+def _load_jks(data, alias, store_pass, key_pass):
+    if hashlib.sha1(store_pass.encode("utf-16-be") + b"Mighty Aphrodite" + data[:-20]).digest() != data[-20:]:
+        raise ApkSignError("Wrong keystore password or corrupted keystore")
+    version, count = struct.unpack_from(">II", data, 4)
+    pos = 12
+    for _ in range(count):
+        tag = struct.unpack_from(">I", data, pos)[0]
+        name, pos = _java_utf(data, pos + 4)
+        pos += 8
+        if tag == _JKS_PRIVATE_KEY:
+            n = struct.unpack_from(">I", data, pos)[0]
+            protected = data[pos + 4:pos + 4 + n]
+            pos += 4 + n
+            chain_length = struct.unpack_from(">I", data, pos)[0]
+            pos += 4
+            chain = []
+            for _ in range(chain_length):
+                if version == 2:
+                    _, pos = _java_utf(data, pos)
+                n = struct.unpack_from(">I", data, pos)[0]
+                chain.append(data[pos + 4:pos + 4 + n])
+                pos += 4 + n
+            if name.lower() == alias.lower():
+                return Signer(name, _jks_decrypt_key(protected, key_pass), chain)
+        elif tag == _JKS_TRUSTED_CERT:
+            if version == 2:
+                _, pos = _java_utf(data, pos)
+            pos += 4 + struct.unpack_from(">I", data, pos)[0]
+        else:
+            raise ApkSignError(f"Unsupported JKS entry type {tag}")
+    raise ApkSignError(f"Alias {alias} not found in keystore")
+
+def _load_pkcs12(data, alias, store_pass):
+    try:
+        store = pkcs12.load_pkcs12(data, store_pass.encode("utf-8"))
+    except ValueError as e:
+        raise ApkSignError(f"Cannot open keystore: {e}") from e
+    if store.key is None or store.cert is None:
+        raise ApkSignError("Keystore has no private key entry")
+    name = store.cert.friendly_name
+    if name is not None and name.decode("utf-8", "replace").lower() != alias.lower():
+        raise ApkSignError(f"Alias {alias} not found in keystore")
+    chain = [store.cert.certificate] + [c.certificate for c in store.additional_certs]
+    return Signer(alias, store.key, [c.public_bytes(serialization.Encoding.DER) for c in chain])
+
+def load_signer(keystore, alias, store_pass, key_pass=None):
+    """Read the signing key and certificate chain from a JKS or PKCS12 keystore."""
+    if not available():
+        raise ApkSignError("The cryptography package is not installed")
+    with open(keystore, "rb") as f:
+        data = f.read()
+    if len(data) >= 4 and struct.unpack_from(">I", data)[0] == _JKS_MAGIC:
+        return _load_jks(data, alias, store_pass, key_pass or store_pass)
+    return _load_pkcs12(data, alias, store_pass)
+
+# --- digest cache -----------------------------------------------------------
+
+class DigestCache:
+    """Signing digests of earlier builds, in one sqlite file under cache/.
+
+    chunks: v2 chunk digests keyed by (offset, fingerprint of the entries
+    the chunk covers). entries: v1 digests of uncompressed entry data keyed by
+    (algorithm, CRC32, size, content_id).
+    """
+
+    TABLES = {
+        "chunks": ("offset", "fingerprint"),
+        "entries": ("algorithm", "crc", "size", "content_id"),
+    }
+
+    def __init__(self, path=DIGEST_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        for table, columns in self.TABLES.items():
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)}, digest BLOB, used REAL, "
+                            f"PRIMARY KEY ({', '.join(columns)}))")
+            self.db.execute(f"DELETE FROM {table} WHERE used < ?", (time.time() - DIGEST_CACHE_MAX_AGE,))
+        self.db.commit()
+
+    def lookup(self, table, keys):
+        where = " AND ".join(f"{column} = ?" for column in self.TABLES[table])
+        found = {}
+        for key in keys:
+            row = self.db.execute(f"SELECT digest FROM {table} WHERE {where}", key).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        now = time.time()
+        self.db.executemany(f"UPDATE {table} SET used = ? WHERE {where}", [(now,) + key for key in found])
+        self.db.commit()
+        return found
+
+    def store(self, table, items):
+        now = time.time()
+        placeholders = ", ".join("?" * (len(self.TABLES[table]) + 2))
+        self.db.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})",
+                            [key + (digest, now) for key, digest in items])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# --- v1 (JAR signing) -------------------------------------------------------
+
+def _manifest_line(name, value):
+    """One manifest attribute, wrapped to 72 bytes per line."""
+    line = f"{name}: {value}".encode("utf-8")
+    out = [line[:72]]
+    for i in range(72, len(line), 71):
+        out.append(b" " + line[i:i + 71])
+    return b"\r\n".join(out) + b"\r\n"
+
+def _v1_entry_name(signer):
+    # apksigner's convention: the alias, upper-cased, at most 8 safe characters.
+    name = re.sub(r"[^A-Z0-9_-]", "_", signer.name.upper())[:8]
+    return name or "CERT"
+
+def _v1_entry_digests(path, infos, digest_name, workers, content_ids, cache):
+    """Return ({name: digest}, entries taken from the cache)."""
+    keys = {}
+    for info in infos:
+        content_id = content_ids.get(info.filename)
+        if content_id is not None:
+            keys[info.filename] = (digest_name, info.CRC, info.file_size, content_id)
+    cached = cache.lookup("entries", list(set(keys.values()))) if cache is not None else {}
+    names = [info.filename for info in infos if keys.get(info.filename) not in cached]
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def digest(name):
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(path)
+            with lock:
+                handles.append(zf)
+        h = hashlib.new(digest_name)
+        with zf.open(name) as f:
+            for block in iter(lambda: f.read(apkzip.COPY_BUFFER), b""):
+                h.update(block)
+        return h.digest()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            computed = dict(zip(names, pool.map(digest, names)))
+    finally:
+        for zf in handles:
+            zf.close()
+    if cache is not None:
+        cache.store("entries", [(keys[name], d) for name, d in computed.items() if name in keys])
+    digests = {info.filename: computed.get(info.filename) or cached[keys[info.filename]] for info in infos}
+    return digests, len(infos) - len(names)
+
+def _pkcs7_signed_data(signer, content, digest_name):
+    """Detached PKCS#7 SignedData without signed attributes, as apksigner writes it."""
+    digest_oid = {"sha1": "1.3.14.3.2.26", "sha256": "2.16.840.1.101.3.4.2.1"}[digest_name]
+    hash_algorithm = hashes.SHA1() if digest_name == "sha1" else hashes.SHA256()
+    if signer.algorithm == SIG_RSA_PKCS1_SHA256:
+        signature_alg = _der_seq(_der_oid("1.2.840.113549.1.1.1"), b"\x05\x00")
+    else:
+        signature_alg = _der_seq(_der_oid("1.2.840.10045.4.1" if digest_name == "sha1" else "1.2.840.10045.4.3.2"))
+    digest_alg = _der_seq(_der_oid(digest_oid), b"\x05\x00")
+    signer_info = _der_seq(
+        _der_int(1),
+        _der_seq(signer.certificate.issuer.public_bytes(), _der_int(signer.certificate.serial_number)),
+        digest_alg,
+        signature_alg,
+        _der(0x04, signer.sign(content, hash_algorithm)))
+    signed_data = _der_seq(
+        _der_int(1),
+        _der_set(digest_alg),
+        _der_seq(_der_oid("1.2.840.113549.1.7.1")),
+        _der(0xA0, b"".join(signer.certificates)),
+        _der_set(signer_info))
+    return _der_seq(_der_oid("1.2.840.113549.1.7.2"), _der(0xA0, signed_data))
+
+def v1_signature_files(path, signer, min_sdk, workers=HASH_WORKERS, entries=None, cache=None):
+    """Return {name: bytes} for META-INF/MANIFEST.MF and the .SF/.RSA pair.
+
+    entries (ApkWriter records matching the file) and a DigestCache let
+    unchanged entries skip inflating and hashing.
+    """
+    digest_name = "sha256" if min_sdk >= V1_SHA256_MIN_SDK else "sha1"
+    attr = "SHA-256-Digest" if digest_name == "sha256" else "SHA1-Digest"
+    with zipfile.ZipFile(path) as zf:
+        infos = [info for info in zf.infolist()
+                 if not info.is_dir() and not apkzip.is_signature_file(info.filename)]
+    names = [info.filename for info in infos]
+    content_ids = {e.name: e.content_id for e in entries} if entries is not None else {}
+    digests, reused = _v1_entry_digests(path, infos, digest_name, workers, content_ids, cache)
+    logging.info(f"v1 digests: {reused} of {len(infos)} entries reused")
+    main = b"Manifest-Version: 1.0\r\nCreated-By: 1.0 (Android)\r\n\r\n"
+    sections = []
+    for name in names:
+        sections.append(_manifest_line("Name", name)
+                        + _manifest_line(attr, base64.b64encode(digests[name]).decode("ascii")) + b"\r\n")
+    manifest = main + b"".join(sections)
+    sf = [b"Signature-Version: 1.0\r\nCreated-By: 1.0 (Android)\r\n",
+          _manifest_line(attr + "-Manifest",
+                         base64.b64encode(hashlib.new(digest_name, manifest).digest()).decode("ascii")),
+          _manifest_line(attr + "-Manifest-Main-Attributes",
+                         base64.b64encode(hashlib.new(digest_name, main).digest()).decode("ascii")),
+          b"X-Android-APK-Signed: 2, 3\r\n\r\n"]
+    for name, section in zip(names, sections):
+        sf.append(_manifest_line("Name", name)
+                  + _manifest_line(attr, base64.b64encode(hashlib.new(digest_name, section).digest()).decode("ascii"))
+                  + b"\r\n")
+    sf = b"".join(sf)
+    base = "META-INF/" + _v1_entry_name(signer)
+    extension = ".RSA" if signer.algorithm == SIG_RSA_PKCS1_SHA256 else ".EC"
+    return {
+        "META-INF/MANIFEST.MF": manifest,
+        base + ".SF": sf,
+        base + extension: _pkcs7_signed_data(signer, sf, digest_name),
+    }
+
+# --- v2 / v3 ----------------------------------------------------------------
+
+def _lp(data):
+    return struct.pack("<I", len(data)) + data
+
+def _lp_seq(items):
+    return _lp(b"".join(_lp(item) for item in items))
+
+def _chunk_digest(data):
+    return hashlib.sha256(b"\xa5" + struct.pack("<I", len(data)) + data).digest()
+
+def _chunk_ranges(length):
+    return [(start, min(CHUNK_SIZE, length - start)) for start in range(0, length, CHUNK_SIZE)]
+
+def chunk_fingerprints(entries, length):
+    """Fingerprint each chunk of the first length bytes from the entries it covers.
+
+    A chunk gets None when any entry touching it has no content_id, i.e. its
+    bytes cannot be vouched for without reading them.
+    """
+    entries = sorted(entries, key=lambda e: e.header_offset)
+    offsets = [e.header_offset for e in entries]
+    if not entries or offsets[0] != 0:
+        return [None] * len(_chunk_ranges(length))
+    fingerprints = []
+    for start, size in _chunk_ranges(length):
+        first = bisect.bisect_right(offsets, start) - 1
+        last = bisect.bisect_left(offsets, start + size)
+        covered = entries[first:last]
+        if any(e.content_id is None for e in covered):
+            fingerprints.append(None)
+            continue
+        h = hashlib.sha256(f"{apkzip.LAYOUT_VERSION}|{start}|{size}".encode("utf-8"))
+        for e in covered:
+            h.update(f"\0{e.header_offset}|{e.name}|{e.compress_type}|{e.date_time}|{e.crc}|{e.compress_size}|"
+                     f"{e.file_size}|{e.zip64}|{e.alignment}|{e.padding}|{e.content_id}".encode("utf-8"))
+        fingerprints.append(h.hexdigest())
+    return fingerprints
+
+def hash_entries_section(path, length, workers=HASH_WORKERS, fingerprints=None, cache=None):
+    """Chunk digests of the first length bytes of path, hashed on a thread pool.
+
+    With fingerprints and a DigestCache, only chunks not seen in an
+    earlier build are read and hashed. Returns (digests, chunks from cache).
+    """
+    ranges = _chunk_ranges(length)
+    keys = [(start, fp) if fp else None for (start, _), fp in zip(ranges, fingerprints or [None] * len(ranges))]
+    cached = cache.lookup("chunks", [key for key in keys if key]) if cache is not None else {}
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def digest(chunk):
+        fp = getattr(local, "fp", None)
+        if fp is None:
+            fp = local.fp = open(path, "rb")
+            with lock:
+                handles.append(fp)
+        fp.seek(chunk[0])
+        data = fp.read(chunk[1])
+        if len(data) != chunk[1]:
+            raise ApkSignError(f"Short read at offset {chunk[0]}")
+        return _chunk_digest(data)
+
+    missing = [i for i, key in enumerate(keys) if key not in cached]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            computed = dict(zip(missing, pool.map(digest, [ranges[i] for i in missing])))
+    finally:
+        for fp in handles:
+            fp.close()
+    if cache is not None:
+        cache.store("chunks", [(keys[i], computed[i]) for i in missing if keys[i]])
+    digests = [computed[i] if i in computed else cached[key] for i, key in enumerate(keys)]
+    return digests, len(ranges) - len(missing)
+
+def content_digest(entry_digests, central_directory, eocd):
+    digests = list(entry_digests)
+    for section in (central_directory, eocd):
+        digests += [_chunk_digest(section[start:start + size]) for start, size in _chunk_ranges(len(section))]
+    return hashlib.sha256(b"\x5a" + struct.pack("<I", len(digests)) + b"".join(digests)).digest()
+
+def _signatures(signer, signed_data):
+    return _lp_seq([struct.pack("<I", signer.algorithm) + _lp(signer.sign(signed_data))])
+
+def v2_block_value(signer, digest):
+    digests = _lp_seq([struct.pack("<I", signer.algorithm) + _lp(digest)])
+    attributes = _lp_seq([struct.pack("<II", STRIPPING_PROTECTION_ATTR, 3)])
+    signed_data = digests + _lp_seq(signer.certificates) + attributes
+    signer_block = _lp(signed_data) + _signatures(signer, signed_data) + _lp(signer.public_key)
+    return _lp_seq([signer_block])
+
+def v3_block_value(signer, digest):
+    digests = _lp_seq([struct.pack("<I", signer.algorithm) + _lp(digest)])
+    signed_data = (digests + _lp_seq(signer.certificates)
+                   + struct.pack("<II", V3_MIN_SDK, MAX_SDK) + _lp_seq([]))
+    signer_block = (_lp(signed_data) + struct.pack("<II", V3_MIN_SDK, MAX_SDK)
+                    + _signatures(signer, signed_data) + _lp(signer.public_key))
+    return _lp_seq([signer_block])
+
+def signing_block(pairs):
+    body = b"".join(struct.pack("<QI", len(value) + 4, block_id) + value for block_id, value in pairs)
+    size = len(body) + 8 + len(SIGNING_BLOCK_MAGIC)
+    return struct.pack("<Q", size) + body + struct.pack("<Q", size) + SIGNING_BLOCK_MAGIC
+
+def has_signing_block(fp, cd_offset):
+    if cd_offset < 24:
+        return False
+    fp.seek(cd_offset - 16)
+    return fp.read(16) == SIGNING_BLOCK_MAGIC
+
+def manifest_min_sdk(path):
+    with zipfile.ZipFile(path) as zf:
+        try:
+            value = axml.min_sdk_version(zf.read("AndroidManifest.xml"))
+        except (KeyError, axml.AxmlError, struct.error, IndexError, UnicodeError) as e:
+            raise ApkSignError(f"Cannot read minSdkVersion: {e}") from e
+    return value if isinstance(value, int) else 1
+
+def _cacheable_layout(layout, infos):
+    """Entries as written by ApkWriter, if they still describe the file."""
+    if layout is None or len(layout) != len(infos):
+        return None
+    by_name = {e.name: e for e in layout}
+    for info in infos:
+        known = by_name.get(info.filename)
+        if known is None:
+            return None
+        if (known.header_offset, known.crc, known.compress_size) != (info.header_offset, info.CRC, info.compress_size):
+            return None
+    return list(layout)
+
+def sign_apk(path, signer, min_sdk=None, workers=HASH_WORKERS, layout=None, use_cache=True):
+    """Sign an unsigned APK in place with v2 and v3 signatures, plus v1 below API 24.
+
+    Only the v1 files, the APK Signing Block and a new central directory are
+    written; the entries already in the file are read for hashing but never
+    rewritten. layout is the entry list returned by apkzip.assemble_apk; with
+    it, v1 and v2 digests are taken from earlier builds where possible, and the
+    returned list describes the signed file for apkzip.check_layout (None
+    without a usable layout).
+    """
+    if min_sdk is None:
+        min_sdk = manifest_min_sdk(path)
+    started = time.perf_counter()
+    try:
+        with open(path, "rb") as fp:
+            try:
+                cd_offset, _, _ = apkzip.read_end_record(fp)
+            except zipfile.LargeZipFile as e:
+                raise ApkTooLargeError(f"APK is a zip64 archive and cannot be signed: {e}") from e
+            if has_signing_block(fp, cd_offset):
+                raise ApkSignError("APK is already signed")
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+        entries = _cacheable_layout(layout, infos)
+        cache = DigestCache() if use_cache and entries is not None else None
+        try:
+            v1_files = {}
+            if min_sdk < V2_MIN_SDK:
+                v1_files = v1_signature_files(path, signer, min_sdk, workers, entries, cache)
+                with apkzip.ApkWriter(path, append=True) as out:
+                    for name, data in v1_files.items():
+                        out.write_bytes(name, data, zipfile.ZIP_DEFLATED)
+                if entries is not None:
+                    entries += out.entries[len(infos):]
+            with open(path, "r+b") as fp:
+                cd_offset, cd_size, eocd_offset = apkzip.read_end_record(fp)
+                fp.seek(cd_offset)
+                central_directory = fp.read(cd_size)
+                fp.seek(eocd_offset)
+                eocd = fp.read()
+                fingerprints = chunk_fingerprints(entries, cd_offset) if cache is not None else None
+                chunk_digests, reused = hash_entries_section(path, cd_offset, workers, fingerprints, cache)
+                # The digests cover the file as if the signing block were absent.
+                digest = content_digest(chunk_digests, central_directory, eocd)
+                block = signing_block([(V2_BLOCK_ID, v2_block_value(signer, digest)),
+                                       (V3_BLOCK_ID, v3_block_value(signer, digest))])
+                if cd_offset + len(block) > apkzip.ZIP64_LIMIT:
+                    raise ApkTooLargeError(f"APK would be {os.path.getsize(path) + len(block)} bytes with its "
+                                           f"signing block, past the 4 GiB a signed APK can have")
+                eocd = bytearray(eocd)
+                struct.pack_into("<I", eocd, 16, cd_offset + len(block))
+                fp.seek(cd_offset)
+                fp.write(block)
+                fp.write(central_directory)
+                fp.write(eocd)
+                fp.truncate()
+        finally:
+            if cache is not None:
+                cache.close()
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, ValueError, InvalidSignature, sqlite3.Error) as e:
+        raise ApkSignError(str(e)) from e
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(path)
+    v1 = f"v1 {', '.join(v1_files)}" if v1_files else "no v1"
+    logging.info(f"Signed {path} in process ({v1}, v2, v3; minSdk {min_sdk}) "
+                 f"in {elapsed:.2f}s, {size / max(elapsed, 1e-9) / 1e6:.1f} MB/s with {workers} threads; "
+                 f"{reused} of {len(chunk_digests)} v2 chunk digests reused")
+    return entries
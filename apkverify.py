@@ -0,0 +1,254 @@
+"""Verify APK Signature Scheme v2/v3 signatures and entry CRCs.
+
+Usage: python apkverify.py [APK or folder ...]   (default: the output folder)
+
+Builds pass the writer's entry records instead, so only the central
+directory, local headers and signatures are read; --paranoid in the GUI
+forces the full check.
+"""
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import apksign
+import apkzip
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+except ImportError:
+    x509 = None
+
+OUTPUT_DIR = os.path.abspath("output")
+CRC_WORKERS = os.cpu_count() or 1
+
+SCHEMES = {apksign.V2_BLOCK_ID: "v2", apksign.V3_BLOCK_ID: "v3"}
+# Signature algorithms whose content digest is chunked SHA-256.
+SIG_RSA_PSS_SHA256 = 0x0101
+SIG_DSA_SHA256 = 0x0301
+SHA256_ALGORITHMS = (SIG_RSA_PSS_SHA256, apksign.SIG_RSA_PKCS1_SHA256, apksign.SIG_ECDSA_SHA256, SIG_DSA_SHA256)
+
+class VerifyResult:
+    def __init__(self, path):
+        self.path = path
+        self.schemes = []
+        self.errors = []
+        self.warnings = []
+        self.entries = 0
+        self.elapsed = 0.0
+        self.mode = "full"
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def summary(self):
+        status = "OK" if self.ok else "FAILED"
+        schemes = ", ".join(self.schemes) or "no v2/v3"
+        lines = [f"{status}  {self.path}  ({schemes}; {self.entries} entries; {self.mode} check; {self.elapsed:.2f}s)"]
+        lines += [f"  error: {e}" for e in self.errors]
+        lines += [f"  warning: {w}" for w in self.warnings]
+        return "\n".join(lines)
+
+def _read_lp(data, pos):
+    n = struct.unpack_from("<I", data, pos)[0]
+    if pos + 4 + n > len(data):
+        raise ValueError("length prefix runs past its parent")
+    return data[pos + 4:pos + 4 + n], pos + 4 + n
+
+def _lp_items(data):
+    items = []
+    pos = 0
+    while pos < len(data):
+        item, pos = _read_lp(data, pos)
+        items.append(item)
+    return items
+
+def find_signing_block(fp, cd_offset):
+    """Return (block offset, {id: value}) or (None, {}) when the APK has no signing block."""
+    if not apksign.has_signing_block(fp, cd_offset):
+        return None, {}
+    fp.seek(cd_offset - 24)
+    size = struct.unpack("<Q", fp.read(8))[0]
+    start = cd_offset - size - 8
+    if start < 0:
+        raise ValueError("APK Signing Block size out of range")
+    fp.seek(start)
+    block = fp.read(size + 8)
+    if struct.unpack_from("<Q", block)[0] != size:
+        raise ValueError("APK Signing Block sizes disagree")
+    pairs = {}
+    pos = 8
+    end = len(block) - 24
+    while pos < end:
+        length, block_id = struct.unpack_from("<QI", block, pos)
+        pairs[block_id] = block[pos + 12:pos + 8 + length]
+        pos += 8 + length
+    return start, pairs
+
+def _verify_signature(public_key, algorithm, signature, data):
+    if algorithm == SIG_RSA_PSS_SHA256:
+        public_key.verify(signature, data, padding.PSS(padding.MGF1(hashes.SHA256()), 32), hashes.SHA256())
+    elif algorithm == apksign.SIG_RSA_PKCS1_SHA256:
+        public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+    elif algorithm == apksign.SIG_ECDSA_SHA256:
+        public_key.verify(signature, data, ec.ECDSA(hashes.SHA256()))
+    else:
+        public_key.verify(signature, data, hashes.SHA256())
+
+def verify_signer(scheme, signer_block, digest, result):
+    signed_data, pos = _read_lp(signer_block, 0)
+    if scheme == "v3":
+        pos += 8
+    signatures, pos = _read_lp(signer_block, pos)
+    public_key, _ = _read_lp(signer_block, pos)
+    digests, pos = _read_lp(signed_data, 0)
+    certificates, _ = _read_lp(signed_data, pos)
+    listed = {}
+    for item in _lp_items(digests):
+        algorithm = struct.unpack_from("<I", item)[0]
+        listed[algorithm], _ = _read_lp(item, 4)
+    checked = [a for a in listed if a in SHA256_ALGORITHMS]
+    if not checked:
+        result.warnings.append(f"{scheme}: no SHA-256 based digest to check")
+    for algorithm in checked:
+        if digest is not None and listed[algorithm] != digest:
+            result.errors.append(f"{scheme}: content digest mismatch (algorithm {algorithm:#06x})")
+    if x509 is None:
+        result.warnings.append(f"{scheme}: signatures not checked, the cryptography package is not installed")
+        return
+    key = serialization.load_der_public_key(public_key)
+    verified = bad = 0
+    for item in _lp_items(signatures):
+        algorithm = struct.unpack_from("<I", item)[0]
+        if algorithm not in SHA256_ALGORITHMS:
+            continue
+        signature, _ = _read_lp(item, 4)
+        try:
+            _verify_signature(key, algorithm, signature, signed_data)
+            verified += 1
+        except InvalidSignature:
+            bad += 1
+            result.errors.append(f"{scheme}: bad signature (algorithm {algorithm:#06x})")
+    if not verified and not bad:
+        result.errors.append(f"{scheme}: no verifiable signature")
+    certs = _lp_items(certificates)
+    if not certs:
+        result.errors.append(f"{scheme}: signer has no certificate")
+    else:
+        cert_key = x509.load_der_x509_certificate(certs[0]).public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        if cert_key != public_key:
+            result.errors.append(f"{scheme}: certificate does not match the signing key")
+
+def verify_signatures(path, result, workers=apksign.HASH_WORKERS, recompute=True):
+    """Check the v2/v3 signers; recompute=False trusts the content digest they list."""
+    with open(path, "rb") as fp:
+        cd_offset, cd_size, eocd_offset = apkzip.read_end_record(fp)
+        block_offset, pairs = find_signing_block(fp, cd_offset)
+        if block_offset is None:
+            result.errors.append("no APK Signing Block")
+            return
+        fp.seek(cd_offset)
+        central_directory = fp.read(cd_size)
+        fp.seek(eocd_offset)
+        eocd = bytearray(fp.read())
+    digest = None
+    if recompute:
+        # The digest covers the APK as if the signing block were not there.
+        struct.pack_into("<I", eocd, 16, block_offset)
+        chunk_digests, _ = apksign.hash_entries_section(path, block_offset, workers)
+        digest = apksign.content_digest(chunk_digests, central_directory, bytes(eocd))
+    for block_id, scheme in SCHEMES.items():
+        if block_id not in pairs:
+            continue
+        signers = _lp_items(_read_lp(pairs[block_id], 0)[0])
+        if not signers:
+            result.errors.append(f"{scheme}: no signers")
+        for signer_block in signers:
+            verify_signer(scheme, signer_block, digest, result)
+        result.schemes.append(scheme)
+    if not result.schemes:
+        result.errors.append("APK Signing Block has no v2 or v3 signature")
+
+def verify_entries(path, result, workers=CRC_WORKERS):
+    """Inflate every entry on a thread pool; zipfile checks the CRC at EOF."""
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def check(name):
+        zf = getattr(local, "zf", None)
+        if zf is None:
+            zf = local.zf = zipfile.ZipFile(path)
+            with lock:
+                handles.append(zf)
+        try:
+            with zf.open(name) as f:
+                while f.read(apkzip.COPY_BUFFER):
+                    pass
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            return f"{name}: {e}"
+        return None
+
+    with zipfile.ZipFile(path) as zf:
+        names = [info.filename for info in zf.infolist() if not info.is_dir()]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            problems = [p for p in pool.map(check, names) if p]
+    finally:
+        for zf in handles:
+            zf.close()
+    result.entries = len(names)
+    result.errors += problems
+
+def verify_apk(path, check_entries=True, workers=CRC_WORKERS, layout=None, paranoid=False):
+    """Verify path; with layout (ApkWriter records of the file) and not paranoid,
+    entry data is not reread and the records are cross-checked instead."""
+    result = VerifyResult(path)
+    quick = layout is not None and not paranoid
+    started = time.perf_counter()
+    try:
+        verify_signatures(path, result, workers, recompute=not quick)
+        if quick:
+            result.mode = "layout"
+            result.entries = len(layout)
+            result.errors += apkzip.check_layout(path, layout)
+        elif check_entries:
+            verify_entries(path, result, workers)
+    except (OSError, ValueError, struct.error, zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+        result.errors.append(str(e))
+    result.elapsed = time.perf_counter() - started
+    return result
+
+def _expand(args):
+    paths = []
+    for arg in args or [OUTPUT_DIR]:
+        if os.path.isdir(arg):
+            paths += sorted(glob.glob(os.path.join(arg, "*.apk")))
+        else:
+            paths.append(arg)
+    return paths
+
+def main(args):
+    paths = _expand(args)
+    if not paths:
+        print("No APK files to verify")
+        return 2
+    failed = 0
+    for path in paths:
+        result = verify_apk(path)
+        print(result.summary())
+        failed += not result.ok
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,611 @@
+import hashlib
+import logging
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import packpolicy
+
+COMPRESS_LEVEL = 6
+COPY_BUFFER = 1024 * 1024
+# Assets are deflated in independent blocks on a thread pool (zlib releases
+# the GIL). Each block is primed with the previous 32 KiB as a dictionary and
+# ends on a sync flush, so the concatenated blocks form one valid stream.
+BLOCK_SIZE = 1024 * 1024
+DICT_SIZE = 32 * 1024
+ASSET_WORKERS = os.cpu_count() or 1
+# Largest size or offset a classic zip field holds; 0xFFFFFFFF means "see the
+# zip64 extra". APKs stay classic up to 4 GiB, as apksig rejects zip64.
+ZIP64_LIMIT = 0xFFFFFFFE
+# Entries written by Kiridroid get a fixed timestamp so identical inputs give
+# identical bytes.
+FIXED_DATE_TIME = (1981, 1, 1, 1, 1, 2)
+# zipalign in the same pass: stored entries start on a 4-byte boundary so they
+# can be mmapped, stored native libraries on a page boundary (16 KiB also
+# satisfies 4 KiB page devices). Padding goes into an Android 0xD935 extra field.
+ALIGNMENT = 4
+PAGE_ALIGNMENT = 16 * 1024
+_ALIGNMENT_EXTRA_ID = 0xD935
+# Everything besides the inputs that decides the bytes this module writes.
+# Entries carry a content_id so identical bytes can be recognised without
+# reading them back (see apksign's chunk digest cache).
+LAYOUT_VERSION = f"1/zlib-{zlib.ZLIB_RUNTIME_VERSION}/{COMPRESS_LEVEL}/{BLOCK_SIZE}/{DICT_SIZE}"
+
+_LOCAL = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+_EOCD = struct.Struct("<IHHHHIIH")
+_EOCD64 = struct.Struct("<IQHHIIQQQQ")
+_EOCD64_LOCATOR = struct.Struct("<IIQI")
+_LOCAL_SIG = 0x04034B50
+_CENTRAL_SIG = 0x02014B50
+_EOCD_SIG = 0x06054B50
+_EOCD64_SIG = 0x06064B50
+_EOCD64_LOCATOR_SIG = 0x07064B50
+_UTF8_FLAG = 0x800
+
+class ZipEntry:
+    def __init__(self, name, compress_type, date_time):
+        self.name = name
+        self.compress_type = compress_type
+        self.date_time = date_time
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.header_offset = 0
+        self.data_offset = 0
+        self.zip64 = False
+        self.alignment = 0
+        self.padding = 0
+        self.content_id = None
+
+    @property
+    def flag_bits(self):
+        return 0 if self.name.isascii() else _UTF8_FLAG
+
+    @property
+    def dos_time(self):
+        y, mo, d, h, mi, s = self.date_time
+        return (h << 11) | (mi << 5) | (s // 2), ((y - 1980) << 9) | (mo << 5) | d
+
+class _Cancelled(Exception):
+    pass
+
+def file_id(kind, path):
+    st = os.stat(path)
+    return f"{kind}:{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+def entry_alignment(name, compress_type):
+    if compress_type != zipfile.ZIP_STORED:
+        return 0
+    if name.startswith("lib/") and name.endswith(".so"):
+        return PAGE_ALIGNMENT
+    return ALIGNMENT
+
+def _deflate_block(block, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _put(out_queue, item, stop):
+    while True:
+        if stop.is_set():
+            raise _Cancelled()
+        try:
+            out_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _read_blocks(items, pool, out_queue, stop):
+    """Producer: read files in order, CRC them and hand blocks to the pool."""
+    try:
+        for name, path, compress_type in items:
+            _put(out_queue, ("begin", name, compress_type, os.path.getsize(path), file_id("blocks", path)), stop)
+            deflate = compress_type == zipfile.ZIP_DEFLATED
+            crc = total = 0
+            previous = b""
+            with open(path, "rb") as f:
+                block = f.read(BLOCK_SIZE)
+                while True:
+                    following = f.read(BLOCK_SIZE) if len(block) == BLOCK_SIZE else b""
+                    last = not following
+                    crc = zlib.crc32(block, crc)
+                    total += len(block)
+                    if deflate:
+                        data = pool.submit(_deflate_block, block, previous[-DICT_SIZE:], last)
+                    else:
+                        data = block
+                    _put(out_queue, ("data", data), stop)
+                    if last:
+                        break
+                    previous, block = block, following
+            _put(out_queue, ("end", crc, total), stop)
+        _put(out_queue, None, stop)
+    except _Cancelled:
+        pass
+    except BaseException as e:
+        try:
+            _put(out_queue, ("error", e), stop)
+        except _Cancelled:
+            pass
+
+class ZipSource:
+    """Read side of a zip whose entries are copied without inflating them."""
+
+    def __init__(self, path):
+        self.path = path
+        self.zf = zipfile.ZipFile(path)
+        self.fp = open(path, "rb")
+
+    def infolist(self):
+        return self.zf.infolist()
+
+    def data_offset(self, info):
+        self.fp.seek(info.header_offset)
+        header = self.fp.read(_LOCAL.size)
+        fields = _LOCAL.unpack(header)
+        if fields[0] != _LOCAL_SIG:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename} in {self.path}")
+        return info.header_offset + _LOCAL.size + fields[9] + fields[10]
+
+    def close(self):
+        self.fp.close()
+        self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_end_record(fp):
+    """Return (central directory offset, size, EOCD offset) of a zip without a zip64 end record."""
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    tail_size = min(size, _EOCD.size + 0xFFFF)
+    fp.seek(size - tail_size)
+    tail = fp.read(tail_size)
+    pos = tail.rfind(struct.pack("<I", _EOCD_SIG))
+    while pos >= 0:
+        fields = _EOCD.unpack_from(tail, pos)
+        if pos + _EOCD.size + fields[7] == len(tail):
+            break
+        pos = tail.rfind(struct.pack("<I", _EOCD_SIG), 0, pos)
+    if pos < 0:
+        raise zipfile.BadZipFile("End of central directory not found")
+    eocd_offset = size - tail_size + pos
+    if eocd_offset >= _EOCD64_LOCATOR.size:
+        fp.seek(eocd_offset - _EOCD64_LOCATOR.size)
+        if struct.unpack("<I", fp.read(4))[0] == _EOCD64_LOCATOR_SIG:
+            raise zipfile.LargeZipFile("zip64 archives are not supported here")
+    cd_size, cd_offset = fields[5], fields[6]
+    if cd_offset + cd_size > eocd_offset:
+        raise zipfile.BadZipFile("Central directory overlaps the end record")
+    return cd_offset, cd_size, eocd_offset
+
+class ApkWriter:
+    """Streaming zip writer.
+
+    append=True reopens an existing APK written without zip64: new entries go
+    where its central directory was, and the directory is rewritten on close.
+    If the writer fails, the original directory is put back.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.entries = []
+        self._names = set()
+        self._original_tail = None
+        if append:
+            self.fp = open(path, "r+b")
+            self._load_existing()
+        else:
+            self.fp = open(path, "wb")
+
+    def _load_existing(self):
+        cd_offset, _, _ = read_end_record(self.fp)
+        self.fp.seek(cd_offset)
+        self._original_tail = (cd_offset, self.fp.read())
+        with zipfile.ZipFile(self.path) as zf:
+            for info in zf.infolist():
+                entry = ZipEntry(info.filename, info.compress_type, info.date_time)
+                entry.crc = info.CRC
+                entry.compress_size = info.compress_size
+                entry.file_size = info.file_size
+                entry.header_offset = info.header_offset
+                self.entries.append(entry)
+                self._names.add(info.filename)
+        self.fp.seek(cd_offset)
+        self.fp.truncate()
+
+    def _begin(self, name, compress_type, date_time, zip64):
+        if name in self._names:
+            raise ValueError(f"Duplicate zip entry: {name}")
+        self._names.add(name)
+        entry = ZipEntry(name, compress_type, date_time)
+        entry.header_offset = self.fp.tell()
+        entry.zip64 = zip64
+        entry.alignment = entry_alignment(name, compress_type)
+        if entry.alignment:
+            data_offset = (entry.header_offset + _LOCAL.size + len(name.encode("utf-8"))
+                           + (20 if zip64 else 0) + 6)
+            entry.padding = -data_offset % entry.alignment
+        return entry
+
+    def _write_local_header(self, entry):
+        name = entry.name.encode("utf-8")
+        dos_time, dos_date = entry.dos_time
+        if entry.zip64:
+            extra = struct.pack("<HHQQ", 1, 16, entry.file_size, entry.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+            version = 45
+        else:
+            extra = b""
+            sizes = (entry.compress_size, entry.file_size)
+            version = 20
+        if entry.alignment:
+            extra += struct.pack("<HHH", _ALIGNMENT_EXTRA_ID, 2 + entry.padding, entry.alignment)
+            extra += bytes(entry.padding)
+        self.fp.write(_LOCAL.pack(
+            _LOCAL_SIG, version, entry.flag_bits, entry.compress_type, dos_time, dos_date,
+            entry.crc, sizes[0], sizes[1], len(name), len(extra)))
+        self.fp.write(name)
+        self.fp.write(extra)
+        entry.data_offset = entry.header_offset + _LOCAL.size + len(name) + len(extra)
+
+    def _finish(self, entry):
+        end = self.fp.tell()
+        if end - entry.data_offset != entry.compress_size:
+            raise zipfile.BadZipFile(f"{entry.name}: wrote {end - entry.data_offset} bytes, "
+                                     f"recorded {entry.compress_size}")
+        if not entry.zip64 and (entry.compress_size > ZIP64_LIMIT or entry.file_size > ZIP64_LIMIT):
+            raise zipfile.LargeZipFile(f"{entry.name} grew past the zip64 threshold")
+        self.fp.seek(entry.header_offset)
+        self._write_local_header(entry)
+        self.fp.seek(end)
+        self.entries.append(entry)
+        return entry
+
+    def copy_entry(self, source, info, name=None):
+        """Copy an entry from a ZipSource as raw compressed bytes."""
+        if info.flag_bits & 0x1:
+            raise zipfile.BadZipFile(f"Encrypted entry not supported: {info.filename}")
+        zip64 = info.compress_size > ZIP64_LIMIT or info.file_size > ZIP64_LIMIT
+        entry = self._begin(name or info.filename, info.compress_type, info.date_time, zip64)
+        entry.crc = info.CRC
+        entry.compress_size = info.compress_size
+        entry.file_size = info.file_size
+        entry.content_id = f"{file_id('raw', source.path)}:{info.header_offset}"
+        self._write_local_header(entry)
+        source.fp.seek(source.data_offset(info))
+        remaining = info.compress_size
+        while remaining:
+            block = source.fp.read(min(COPY_BUFFER, remaining))
+            if not block:
+                raise zipfile.BadZipFile(f"Truncated entry {info.filename} in {source.path}")
+            self.fp.write(block)
+            remaining -= len(block)
+        return self._finish(entry)
+
+    def write_bytes(self, name, data, compress_type, date_time=FIXED_DATE_TIME):
+        entry = self._begin(name, compress_type, date_time, len(data) > ZIP64_LIMIT)
+        entry.crc = zlib.crc32(data)
+        entry.file_size = len(data)
+        entry.content_id = "bytes:" + hashlib.sha256(data).hexdigest()
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        entry.compress_size = len(data)
+        self._write_local_header(entry)
+        self.fp.write(data)
+        return self._finish(entry)
+
+    def write_file(self, name, path, compress_type):
+        zip64 = os.path.getsize(path) * 1.05 > ZIP64_LIMIT
+        entry = self._begin(name, compress_type, FIXED_DATE_TIME, zip64)
+        entry.content_id = file_id("file", path)
+        self._write_local_header(entry)
+        compressor = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(COPY_BUFFER), b""):
+                entry.crc = zlib.crc32(block, entry.crc)
+                entry.file_size += len(block)
+                if compressor:
+                    block = compressor.compress(block)
+                self.fp.write(block)
+                entry.compress_size += len(block)
+        if compressor:
+            block = compressor.flush()
+            self.fp.write(block)
+            entry.compress_size += len(block)
+        return self._finish(entry)
+
+    def write_files(self, items, workers=ASSET_WORKERS):
+        """Write (name, path, compress_type) items, deflating on a thread pool.
+
+        A reader thread, the compression pool and this (writer) thread run as
+        a pipeline; the bounded queue keeps at most a few blocks per worker
+        in memory, and entries are written in item order.
+        """
+        out_queue = queue.Queue(maxsize=max(2, workers * 4))
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            reader = threading.Thread(target=_read_blocks, args=(items, pool, out_queue, stop), daemon=True)
+            reader.start()
+            try:
+                entry = None
+                while True:
+                    message = out_queue.get()
+                    if message is None:
+                        break
+                    kind = message[0]
+                    if kind == "begin":
+                        _, name, compress_type, size, content_id = message
+                        entry = self._begin(name, compress_type, FIXED_DATE_TIME, size * 1.05 > ZIP64_LIMIT)
+                        entry.content_id = content_id
+                        self._write_local_header(entry)
+                    elif kind == "data":
+                        data = message[1].result() if isinstance(message[1], Future) else message[1]
+                        self.fp.write(data)
+                        entry.compress_size += len(data)
+                    elif kind == "end":
+                        entry.crc, entry.file_size = message[1], message[2]
+                        self._finish(entry)
+                    else:
+                        raise message[1]
+            finally:
+                stop.set()
+                reader.join()
+
+    def _central_directory(self):
+        records = []
+        for entry in self.entries:
+            name = entry.name.encode("utf-8")
+            dos_time, dos_date = entry.dos_time
+            zip64_fields = []
+            compress_size, file_size, offset = entry.compress_size, entry.file_size, entry.header_offset
+            if file_size > ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+                file_size = 0xFFFFFFFF
+            if compress_size > ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+                compress_size = 0xFFFFFFFF
+            if offset > ZIP64_LIMIT:
+                zip64_fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            if zip64_fields:
+                extra = struct.pack(f"<HH{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields)
+            version = 45 if zip64_fields or entry.zip64 else 20
+            records.append(_CENTRAL.pack(
+                _CENTRAL_SIG, version, version, entry.flag_bits, entry.compress_type, dos_time, dos_date,
+                entry.crc, compress_size, file_size, len(name), len(extra), 0, 0, 0, 0, offset))
+            records.append(name)
+            records.append(extra)
+        return b"".join(records)
+
+    def close(self):
+        if self.fp is None:
+            return
+        cd_offset = self.fp.tell()
+        central = self._central_directory()
+        self.fp.write(central)
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_offset > ZIP64_LIMIT or len(central) > ZIP64_LIMIT:
+            eocd64_offset = self.fp.tell()
+            self.fp.write(_EOCD64.pack(_EOCD64_SIG, _EOCD64.size - 12, 45, 45, 0, 0,
+                                       count, count, len(central), cd_offset))
+            self.fp.write(_EOCD64_LOCATOR.pack(_EOCD64_LOCATOR_SIG, 0, eocd64_offset, 1))
+            self.fp.write(_EOCD.pack(_EOCD_SIG, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                     min(len(central), 0xFFFFFFFF), min(cd_offset, 0xFFFFFFFF), 0))
+        else:
+            self.fp.write(_EOCD.pack(_EOCD_SIG, 0, 0, count, count, len(central), cd_offset, 0))
+        self.fp.close()
+        self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._original_tail is not None:
+            cd_offset, tail = self._original_tail
+            self.fp.seek(cd_offset)
+            self.fp.truncate()
+            self.fp.write(tail)
+            self.fp.close()
+            self.fp = None
+        else:
+            self.fp.close()
+            self.fp = None
+            os.remove(self.path)
+
+def check_layout(path, entries):
+    """Compare a written zip against the writer's records without reading entry data.
+
+    Rereads the central directory and every local header; returns a list of
+    problems, empty when the file matches what ApkWriter recorded.
+    """
+    problems = []
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as fp:
+        infos = zf.infolist()
+        if len(infos) != len(entries):
+            return [f"central directory lists {len(infos)} entries, {len(entries)} were written"]
+        for info, entry in zip(infos, entries):
+            expected = (entry.name, entry.compress_type, entry.crc, entry.compress_size,
+                        entry.file_size, entry.header_offset)
+            found = (info.filename, info.compress_type, info.CRC, info.compress_size,
+                     info.file_size, info.header_offset)
+            if found != expected:
+                problems.append(f"{entry.name}: central directory has {found}, expected {expected}")
+                continue
+            fp.seek(entry.header_offset)
+            fields = _LOCAL.unpack(fp.read(_LOCAL.size))
+            name = fp.read(fields[9])
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF) if entry.zip64 else (entry.compress_size, entry.file_size)
+            if (fields[0] != _LOCAL_SIG or name != entry.name.encode("utf-8") or fields[3] != entry.compress_type
+                    or fields[6] != entry.crc or fields[7:9] != sizes):
+                problems.append(f"{entry.name}: local header does not match the central directory")
+            elif entry.data_offset and entry.header_offset + _LOCAL.size + fields[9] + fields[10] != entry.data_offset:
+                problems.append(f"{entry.name}: data starts at an unexpected offset")
+    return problems
+
+def collect_game_assets(game_dir):
+    """List (arcname, path) pairs for every file of the game under assets/."""
+    entries = []
+    names = set()
+    for root, dirs, files in os.walk(game_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            rel = os.path.relpath(path, game_dir).replace(os.sep, "/")
+            entries.append(("assets/" + rel, path))
+            names.add(rel)
+    # Kirikiroid2 boots from gameexe.dat; games that only ship data.xp3 get an alias.
+    if "data.xp3" in names and "gameexe.dat" not in names:
+        entries.append(("assets/gameexe.dat", os.path.join(game_dir, "data.xp3")))
+    return entries
+
+def is_dex(name):
+    return name.startswith("classes") and name.endswith(".dex") and "/" not in name
+
+def is_signature_file(name):
+    if not name.startswith("META-INF/") or name.count("/") != 1:
+        return False
+    base = name[len("META-INF/"):].upper()
+    return (base == "MANIFEST.MF" or base.startswith("SIG-")
+            or os.path.splitext(base)[1] in (".SF", ".RSA", ".DSA", ".EC"))
+
+def shell_lib_compress(shell_apk):
+    """Compress type of the shell's native libraries per lib/<abi> folder."""
+    lib_compress = {}
+    with zipfile.ZipFile(shell_apk) as zf:
+        for info in zf.infolist():
+            if info.filename.startswith("lib/") and info.filename.endswith(".so"):
+                lib_compress.setdefault(os.path.dirname(info.filename), info.compress_type)
+    return lib_compress
+
+def build_overlay(path, base_apk, native_libs, lib_compress):
+    """Write the overlay bundle: the base APK's DEX entries copied raw, and
+    native_libs (ABI -> libc++_shared.so) packed like the shell's own libraries,
+    so a shell that stores its libraries for mmap gets a stored, page-aligned libc++."""
+    lib_entries = {f"lib/{abi}/libc++_shared.so": lib for abi, lib in native_libs.items()}
+    with ZipSource(base_apk) as base, ApkWriter(path) as out:
+        for info in base.infolist():
+            if is_dex(info.filename):
+                out.copy_entry(base, info)
+        for name, lib in sorted(lib_entries.items()):
+            out.write_file(name, lib, lib_compress.get(os.path.dirname(name), zipfile.ZIP_DEFLATED))
+    return out.entries
+
+def assemble_apk(out_path, shell_apk, overlay, game_dir, overrides=None, workers=ASSET_WORKERS):
+    """Write the unsigned APK in one pass.
+
+    Entries of the app shell are copied as raw compressed bytes unless
+    overrides maps their name to new contents, the DEX files and libc++ are
+    spliced in raw from the overlay bundle (see build_overlay) and the game
+    folder is streamed in under assets/. The game goes first, so builds of the
+    same game share their leading bytes whatever the package name. Old
+    signature files are dropped and stored entries are aligned as zipalign -p
+    would, so no separate zipalign run is needed before signing. workers is
+    the size of the deflate pool, the build's admitted share of the CPUs.
+    """
+    overrides = overrides or {}
+    with ZipSource(shell_apk) as shell, ZipSource(overlay) as bundle, ApkWriter(out_path) as out:
+        overlay_infos = bundle.infolist()
+        overlay_names = {info.filename for info in overlay_infos}
+        assets = collect_game_assets(game_dir)
+        policy = packpolicy.CompressionPolicy()
+        started = time.perf_counter()
+        out.write_files([(arcname, path, policy.choose(arcname, path)) for arcname, path in assets], workers)
+        elapsed = time.perf_counter() - started
+        for info in shell.infolist():
+            name = info.filename
+            if info.is_dir() or name in overlay_names or name.startswith("assets/"):
+                continue
+            if is_signature_file(name):
+                continue
+            if name in overrides:
+                out.write_bytes(name, overrides[name], info.compress_type, info.date_time)
+            else:
+                out.copy_entry(shell, info)
+        for info in overlay_infos:
+            out.copy_entry(bundle, info)
+    policy.report(out.entries)
+    asset_bytes = sum(os.path.getsize(path) for _, path in assets)
+    logging.info(f"Assembled {out_path}: {len(out.entries)} entries, {len(assets)} game assets "
+                 f"({asset_bytes} bytes) packed in {elapsed:.2f}s with {workers} workers "
+                 f"({asset_bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+    return out.entries
+
+def bench(game_dir, max_workers=ASSET_WORKERS):
+    """Pack game_dir with 1, 2, 4 ... max_workers threads and print the throughput."""
+    policy = packpolicy.CompressionPolicy()
+    items = [(arcname, path, policy.choose(arcname, path)) for arcname, path in collect_game_assets(game_dir)]
+    total = sum(os.path.getsize(path) for _, path, _ in items)
+    workers = 1
+    baseline = None
+    while True:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            started = time.perf_counter()
+            with ApkWriter(os.path.join(tmpdir, "bench.zip")) as out:
+                out.write_files(items, workers)
+            elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        print(f"workers={workers:3d}  {elapsed:8.2f}s  {total / elapsed / 1e6:8.1f} MB/s  speedup x{baseline / elapsed:.2f}")
+        if workers >= max_workers:
+            break
+        workers = min(workers * 2, max_workers)
+
+def check_large(folder=None, size=(1 << 31) + (256 << 20)):
+    """Regression check: a zip past 2 GiB keeps the classic end record signers accept.
+
+    Writes a stored entry of size bytes from a sparse file into folder (the
+    temp folder by default, which needs that much free space) and an entry
+    after it, then rereads the end record and every header. Returns a list
+    of problems.
+    """
+    with tempfile.TemporaryDirectory(dir=folder) as tmpdir:
+        big = os.path.join(tmpdir, "big.bin")
+        with open(big, "wb") as f:
+            f.truncate(size)
+        path = os.path.join(tmpdir, "large.apk")
+        with ApkWriter(path) as out:
+            out.write_file("assets/big.bin", big, zipfile.ZIP_STORED)
+            out.write_bytes("assets/after.txt", b"after", zipfile.ZIP_DEFLATED)
+        try:
+            with open(path, "rb") as fp:
+                cd_offset, _, _ = read_end_record(fp)
+        except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+            return [str(e)]
+        problems = check_layout(path, out.entries)
+        if cd_offset <= size:
+            problems.append(f"central directory at {cd_offset}, expected past {size}")
+        with zipfile.ZipFile(path) as zf:
+            if zf.read("assets/after.txt") != b"after":
+                problems.append("entry after the large one reads back wrong")
+    return problems
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--check-large":
+        found = check_large(sys.argv[2] if len(sys.argv) > 2 else None)
+        print("\n".join(found) or "ok")
+        sys.exit(1 if found else 0)
+    if len(sys.argv) < 2:
+        print("usage: python apkzip.py <game folder> [max workers]")
+        print("       python apkzip.py --check-large [scratch folder]")
+        sys.exit(2)
+    bench(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else ASSET_WORKERS)
@@ -0,0 +1,149 @@
+"""AppCDS archives for the bundled JDK, one per (JDK, jar), and JVM flags for short tool runs."""
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+
+import memplan
+
+FALLBACK_DIR = os.path.abspath(os.path.join("cache", "cds"))
+# Short runs finish before C2 pays off, and SerialGC starts fastest.
+SHORT_RUN_FLAGS = ["-XX:TieredStopAtLevel=1", "-XX:+UseSerialGC"]
+# CDS warnings (e.g. a stale archive) go to stdout and would end up in the tool output.
+QUIET_FLAGS = ["-Xlog:cds=off", "-Xlog:cds+dynamic=off"]
+# -XX:+AutoCreateSharedArchive needs JDK 19.
+MIN_JAVA_VERSION = 19
+MEASURE_RUNS = 3
+ENABLED = True
+
+def java_home(java_bin):
+    return os.path.dirname(os.path.dirname(os.path.abspath(java_bin)))
+
+def java_version(java_bin):
+    """Feature version from the JDK's release file, or None when it cannot be read."""
+    try:
+        with open(os.path.join(java_home(java_bin), "release"), encoding="utf-8") as f:
+            match = re.search(r'^JAVA_VERSION="(\d+)', f.read(), re.M)
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+def supported(java_bin):
+    version = java_version(java_bin)
+    return ENABLED and version is not None and version >= MIN_JAVA_VERSION
+
+def archive_dir(java_bin):
+    """The archives live next to the toolchain, or under cache/ when its folder is read-only."""
+    folder = os.path.join(java_home(java_bin), "cds")
+    try:
+        os.makedirs(folder, exist_ok=True)
+        if os.access(folder, os.W_OK):
+            return folder
+    except OSError:
+        pass
+    os.makedirs(FALLBACK_DIR, exist_ok=True)
+    return FALLBACK_DIR
+
+def _file_key(path):
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+def archive_path(java_bin, jar, *related):
+    """Archive for running jar on java_bin; a change to the JDK, jar or related files gives a new name."""
+    digest = hashlib.sha256()
+    for path in (java_bin, os.path.join(java_home(java_bin), "release"), jar, *related):
+        digest.update(_file_key(path).encode("utf-8") + b"\0")
+    stem = os.path.splitext(os.path.basename(jar))[0]
+    return os.path.join(archive_dir(java_bin), f"{stem}-{digest.hexdigest()[:16]}.jsa")
+
+def remove_stale(archive):
+    """Delete the archives built for older versions of the same jar."""
+    folder, name = os.path.split(archive)
+    prefix = name.rsplit("-", 1)[0] + "-"
+    for other in os.listdir(folder):
+        if other != name and other.startswith(prefix) and other.endswith(".jsa"):
+            try:
+                os.remove(os.path.join(folder, other))
+                logging.info(f"Removed stale AppCDS archive {other}")
+            except OSError:
+                pass
+
+def archive_flags(archive):
+    # The JVM writes the archive when it exits if it is missing or does not match.
+    return [f"-XX:SharedArchiveFile={archive}", "-XX:+AutoCreateSharedArchive", *QUIET_FLAGS]
+
+def _split(cmd):
+    if "-jar" not in cmd or cmd.index("-jar") + 1 >= len(cmd):
+        return None
+    return cmd[0], cmd[cmd.index("-jar") + 1]
+
+def tune_command(cmd):
+    """Return (cmd with short-run flags and the AppCDS archive, archive path or None)."""
+    parts = _split(cmd)
+    if parts is None or not supported(parts[0]):
+        return cmd, None
+    java_bin, jar = parts
+    try:
+        archive = archive_path(java_bin, jar)
+    except OSError as e:
+        logging.warning(f"AppCDS disabled for {jar}: {e}")
+        return cmd, None
+    return [java_bin, *SHORT_RUN_FLAGS, *archive_flags(archive), *cmd[1:]], archive
+
+def _time_startup(cmd, env=None):
+    best = None
+    for _ in range(MEASURE_RUNS):
+        started = time.perf_counter()
+        subprocess.run(cmd, capture_output=True, env=env)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def measure_startup(java_bin, jar, archive, env=None):
+    """Log the best-of-N startup of "jar --version" with default flags and with the archive."""
+    plain = _time_startup([java_bin, "-jar", jar, "--version"], env)
+    tuned = _time_startup([java_bin, *SHORT_RUN_FLAGS, *archive_flags(archive), "-jar", jar, "--version"], env)
+    logging.info(f"AppCDS startup for {os.path.basename(jar)}: {plain * 1000:.0f} ms without archive, "
+                 f"{tuned * 1000:.0f} ms with archive and short-run flags")
+    return plain, tuned
+
+def run(cmd, text=False, timeout=None, env=None):
+    """subprocess.run(cmd, capture_output=True) with the tuned flags.
+
+    The first run writes the archive; see measure_startup (or run this module)
+    for what it saves.
+    """
+    tuned, archive = tune_command(cmd)
+    fresh = archive is not None and not os.path.exists(archive)
+    with subprocess.Popen(tuned, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text, env=env) as process:
+        memplan.watch(process.pid)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        finally:
+            memplan.unwatch(process.pid)
+    result = subprocess.CompletedProcess(tuned, process.returncode, stdout, stderr)
+    if fresh and os.path.exists(archive):
+        remove_stale(archive)
+        logging.info(f"Created AppCDS archive {os.path.basename(archive)}")
+    return result
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python appcds.py <java> <tool jar>")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    java_bin, jar = sys.argv[1:]
+    if not supported(java_bin):
+        print(f"AppCDS needs JDK {MIN_JAVA_VERSION} or later")
+        sys.exit(1)
+    archive = archive_path(java_bin, jar)
+    if not os.path.exists(archive):
+        run([java_bin, "-jar", jar, "--version"])
+    measure_startup(java_bin, jar, archive)
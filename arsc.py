@@ -0,0 +1,144 @@
+"""Minimal resources.arsc editor: rewrite string resources in place."""
+import struct
+
+from axml import StringPool
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_TABLE_PACKAGE_TYPE = 0x0200
+RES_TABLE_TYPE_TYPE = 0x0201
+
+TYPE_STRING = 0x03
+FLAG_COMPLEX = 0x0001
+FLAG_COMPACT = 0x0008
+TYPE_FLAG_SPARSE = 0x01
+TYPE_FLAG_OFFSET16 = 0x02
+NO_ENTRY = 0xFFFFFFFF
+NO_ENTRY16 = 0xFFFF
+
+_CHUNK = struct.Struct("<HHI")
+
+class ArscError(Exception):
+    pass
+
+class ResourceTable:
+    def __init__(self, data):
+        data = bytes(data)
+        ctype, header_size, size = _CHUNK.unpack_from(data, 0)
+        if ctype != RES_TABLE_TYPE:
+            raise ArscError("Not a resources.arsc table")
+        self.header = bytearray(data[:header_size])
+        self.pool, pool_end = StringPool.parse(data, header_size)
+        self.body = bytearray(data[pool_end:size])
+        self.packages = self._scan_packages()
+
+    def _scan_packages(self):
+        packages = []
+        pos = 0
+        while pos < len(self.body):
+            ctype, header_size, size = _CHUNK.unpack_from(self.body, pos)
+            if size < 8 or pos + size > len(self.body):
+                raise ArscError(f"Corrupt table chunk at {pos:#x}")
+            if ctype == RES_TABLE_PACKAGE_TYPE:
+                package_id = struct.unpack_from("<I", self.body, pos + 8)[0]
+                type_strings, _, key_strings = struct.unpack_from("<III", self.body, pos + 268)
+                types, _ = StringPool.parse(self.body, pos + type_strings)
+                keys, _ = StringPool.parse(self.body, pos + key_strings)
+                packages.append((package_id, pos, size, header_size, types, keys))
+            pos += size
+        return packages
+
+    def _type_chunks(self, package, type_id):
+        _, start, size, header_size, _, _ = package
+        pos = start + header_size
+        end = start + size
+        while pos < end:
+            ctype, chunk_header, chunk_size = _CHUNK.unpack_from(self.body, pos)
+            if chunk_size < 8:
+                raise ArscError(f"Corrupt package chunk at {pos:#x}")
+            if ctype == RES_TABLE_TYPE_TYPE and self.body[pos + 8] == type_id:
+                yield pos, chunk_header
+            pos += chunk_size
+
+    def _entry_offset(self, pos, header_size, index):
+        flags = self.body[pos + 9]
+        entry_count, entries_start = struct.unpack_from("<II", self.body, pos + 12)
+        table = pos + header_size
+        if flags & TYPE_FLAG_SPARSE:
+            for i in range(entry_count):
+                idx, off = struct.unpack_from("<HH", self.body, table + 4 * i)
+                if idx == index:
+                    return pos + entries_start + off * 4
+            return None
+        if index >= entry_count:
+            return None
+        if flags & TYPE_FLAG_OFFSET16:
+            off = struct.unpack_from("<H", self.body, table + 2 * index)[0]
+            return None if off == NO_ENTRY16 else pos + entries_start + off * 4
+        off = struct.unpack_from("<I", self.body, table + 4 * index)[0]
+        return None if off == NO_ENTRY else pos + entries_start + off
+
+    def _entries(self, res_id):
+        """Yield (value data offset, data type) of every config of res_id."""
+        package_id, type_id, index = res_id >> 24, (res_id >> 16) & 0xFF, res_id & 0xFFFF
+        for package in self.packages:
+            if package[0] != package_id:
+                continue
+            for pos, header_size in self._type_chunks(package, type_id):
+                entry = self._entry_offset(pos, header_size, index)
+                if entry is None:
+                    continue
+                size, flags = struct.unpack_from("<HH", self.body, entry)
+                if flags & FLAG_COMPACT:
+                    yield entry + 4, flags >> 8
+                elif not flags & FLAG_COMPLEX:
+                    yield entry + size + 4, self.body[entry + size + 3]
+
+    def resource_id(self, type_name, key_name):
+        for package in self.packages:
+            package_id, start, size, header_size, types, keys = package
+            type_index = types.find(type_name)
+            key_index = keys.find(key_name)
+            if type_index < 0 or key_index < 0:
+                continue
+            for pos, chunk_header in self._type_chunks(package, type_index + 1):
+                entry_count = struct.unpack_from("<I", self.body, pos + 12)[0]
+                for index in range(entry_count):
+                    entry = self._entry_offset(pos, chunk_header, index)
+                    if entry is None:
+                        continue
+                    size16, flags = struct.unpack_from("<HH", self.body, entry)
+                    key = size16 if flags & FLAG_COMPACT else struct.unpack_from("<I", self.body, entry + 4)[0]
+                    if key == key_index:
+                        return (package_id << 24) | ((type_index + 1) << 16) | index
+        return None
+
+    def get_strings(self, res_id):
+        return [self.pool[struct.unpack_from("<I", self.body, off)[0]]
+                for off, data_type in self._entries(res_id) if data_type == TYPE_STRING]
+
+    def set_string(self, res_id, value):
+        """Point every config of a string resource at value; returns configs changed."""
+        targets = [off for off, data_type in self._entries(res_id) if data_type == TYPE_STRING]
+        if not targets:
+            return 0
+        # Append rather than overwrite: the old string may be shared with other resources.
+        ref = self.pool.find(value)
+        if ref < 0:
+            ref = self.pool.append(value)
+        for off in targets:
+            struct.pack_into("<I", self.body, off, ref)
+        return len(targets)
+
+    def to_bytes(self):
+        pool = self.pool.serialize()
+        header = bytearray(self.header)
+        struct.pack_into("<I", header, 4, len(header) + len(pool) + len(self.body))
+        return bytes(header) + pool + bytes(self.body)
+
+def set_string_resources(data, res_ids, value):
+    table = ResourceTable(data)
+    for res_id in res_ids:
+        if not table.set_string(res_id, value):
+            raise ArscError(f"Resource {res_id:#010x} is not a string in resources.arsc")
+    return table.to_bytes()
@@ -0,0 +1,412 @@
+"""Read and write Android binary XML (the compiled AndroidManifest.xml)."""
+import struct
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_NAMESPACE_TYPE = 0x0100
+RES_XML_END_NAMESPACE_TYPE = 0x0101
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_CDATA_TYPE = 0x0104
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_BOOLEAN = 0x12
+
+NO_INDEX = 0xFFFFFFFF
+UTF8_FLAG = 0x100
+SORTED_FLAG = 0x1
+
+ANDROID_NS = "http://schemas.android.com/apk/res/android"
+ATTR_LABEL = 0x01010001
+ATTR_ICON = 0x01010002
+ATTR_NAME = 0x01010003
+ATTR_TARGET_ACTIVITY = 0x01010202
+ATTR_MIN_SDK_VERSION = 0x0101020C
+ATTR_BACKUP_AGENT = 0x0101027F
+ATTR_EXTRACT_NATIVE_LIBS = 0x010104EA
+
+KR2_ACTIVITY = "org.tvp.kirikiri2.KR2Activity"
+COMPONENT_TAGS = ("application", "activity", "activity-alias", "service", "receiver", "provider")
+CLASS_NAME_ATTRS = (ATTR_NAME, ATTR_TARGET_ACTIVITY, ATTR_BACKUP_AGENT)
+
+_CHUNK = struct.Struct("<HHI")
+
+class AxmlError(Exception):
+    pass
+
+def _encode_length_utf8(n):
+    if n > 0x7FFF:
+        raise AxmlError("String too long for the pool")
+    return bytes([n]) if n < 0x80 else bytes([0x80 | (n >> 8), n & 0xFF])
+
+def _encode_length_utf16(n):
+    if n > 0x7FFFFFFF:
+        raise AxmlError("String too long for the pool")
+    if n < 0x8000:
+        return struct.pack("<H", n)
+    return struct.pack("<HH", 0x8000 | (n >> 16), n & 0xFFFF)
+
+class StringPool:
+    """ResStringPool chunk. Untouched strings keep their original encoding."""
+
+    def __init__(self, strings, utf8, raw=None, style_count=0, style_offsets=(), styles=b""):
+        self.strings = list(strings)
+        self.utf8 = utf8
+        self._raw = list(raw) if raw is not None else [None] * len(self.strings)
+        self.style_count = style_count
+        self.style_offsets = list(style_offsets)
+        self.styles = styles
+
+    @classmethod
+    def parse(cls, data, offset=0):
+        ctype, header_size, size = _CHUNK.unpack_from(data, offset)
+        if ctype != RES_STRING_POOL_TYPE:
+            raise AxmlError(f"Expected string pool at {offset:#x}, found chunk {ctype:#06x}")
+        count, style_count, flags, strings_start, styles_start = struct.unpack_from("<IIIII", data, offset + 8)
+        utf8 = bool(flags & UTF8_FLAG)
+        offsets = struct.unpack_from(f"<{count}I", data, offset + header_size)
+        style_offsets = struct.unpack_from(f"<{style_count}I", data, offset + header_size + 4 * count)
+        base = offset + strings_start
+        strings, raw = [], []
+        for rel in offsets:
+            pos = base + rel
+            if utf8:
+                start = pos
+                pos += 2 if data[pos] & 0x80 else 1
+                n = data[pos]
+                if n & 0x80:
+                    n = ((n & 0x7F) << 8) | data[pos + 1]
+                    pos += 2
+                else:
+                    pos += 1
+                strings.append(data[pos:pos + n].decode("utf-8", errors="surrogatepass"))
+                raw.append(bytes(data[start:pos + n + 1]))
+            else:
+                start = pos
+                n = struct.unpack_from("<H", data, pos)[0]
+                pos += 2
+                if n & 0x8000:
+                    n = ((n & 0x7FFF) << 16) | struct.unpack_from("<H", data, pos)[0]
+                    pos += 2
+                strings.append(data[pos:pos + 2 * n].decode("utf-16-le", errors="surrogatepass"))
+                raw.append(bytes(data[start:pos + 2 * n + 2]))
+        styles = b""
+        if style_count:
+            styles = bytes(data[offset + styles_start:offset + size])
+        return cls(strings, utf8, raw, style_count, style_offsets, styles), offset + size
+
+    def _encode(self, i):
+        if self._raw[i] is not None:
+            return self._raw[i]
+        s = self.strings[i]
+        if self.utf8:
+            encoded = s.encode("utf-8", errors="surrogatepass")
+            u16_len = len(s.encode("utf-16-le", errors="surrogatepass")) // 2
+            return _encode_length_utf8(u16_len) + _encode_length_utf8(len(encoded)) + encoded + b"\0"
+        encoded = s.encode("utf-16-le", errors="surrogatepass")
+        return _encode_length_utf16(len(encoded) // 2) + encoded + b"\0\0"
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def set(self, i, s):
+        self.strings[i] = s
+        self._raw[i] = None
+
+    def append(self, s):
+        self.strings.append(s)
+        self._raw.append(None)
+        return len(self.strings) - 1
+
+    def insert(self, i, s):
+        if i < self.style_count:
+            raise AxmlError("Cannot insert a string in front of styled strings")
+        self.strings.insert(i, s)
+        self._raw.insert(i, None)
+
+    def find(self, s):
+        try:
+            return self.strings.index(s)
+        except ValueError:
+            return -1
+
+    def serialize(self):
+        offsets, blobs, pos = [], [], 0
+        for i in range(len(self.strings)):
+            blob = self._encode(i)
+            offsets.append(pos)
+            blobs.append(blob)
+            pos += len(blob)
+        string_data = b"".join(blobs)
+        string_data += b"\0" * (-len(string_data) % 4)
+        header_size = 28
+        count = len(self.strings)
+        strings_start = header_size + 4 * (count + self.style_count)
+        styles_start = strings_start + len(string_data) if self.style_count else 0
+        size = strings_start + len(string_data) + len(self.styles)
+        flags = UTF8_FLAG if self.utf8 else 0
+        header = struct.pack("<HHIIIIII", RES_STRING_POOL_TYPE, header_size, size, count,
+                             self.style_count, flags, strings_start, styles_start)
+        return (header + struct.pack(f"<{count}I", *offsets)
+                + struct.pack(f"<{self.style_count}I", *self.style_offsets)
+                + string_data + self.styles)
+
+class Attribute:
+    def __init__(self, ns, name, raw_value, data_type, data):
+        self.ns = ns
+        self.name = name
+        self.raw_value = raw_value
+        self.data_type = data_type
+        self.data = data
+
+class Node:
+    def __init__(self, ctype, line, comment, fields, attrs=None, typed=None, raw=None):
+        self.type = ctype
+        self.line = line
+        self.comment = comment
+        self.fields = fields
+        self.attrs = attrs
+        self.typed = typed
+        self.raw = raw
+
+class AxmlDocument:
+    def __init__(self, pool, resource_ids, nodes):
+        self.pool = pool
+        self.resource_ids = resource_ids
+        self.nodes = nodes
+
+    @classmethod
+    def parse(cls, data):
+        if len(data) < 8:
+            raise AxmlError("File too short for binary XML")
+        ctype, header_size, size = _CHUNK.unpack_from(data, 0)
+        if ctype != RES_XML_TYPE:
+            raise AxmlError("Not a binary XML document")
+        pool, pos = StringPool.parse(data, header_size)
+        resource_ids = []
+        nodes = []
+        end = min(size, len(data))
+        while pos < end:
+            ctype, chunk_header, chunk_size = _CHUNK.unpack_from(data, pos)
+            if chunk_size < 8 or pos + chunk_size > end:
+                raise AxmlError(f"Corrupt chunk at {pos:#x}")
+            if ctype == RES_XML_RESOURCE_MAP_TYPE:
+                n = (chunk_size - chunk_header) // 4
+                resource_ids = list(struct.unpack_from(f"<{n}I", data, pos + chunk_header))
+            elif RES_XML_START_NAMESPACE_TYPE <= ctype <= RES_XML_CDATA_TYPE:
+                nodes.append(cls._parse_node(data, pos, ctype, chunk_header, chunk_size))
+            else:
+                nodes.append(Node(ctype, 0, NO_INDEX, (), raw=bytes(data[pos:pos + chunk_size])))
+            pos += chunk_size
+        return cls(pool, resource_ids, nodes)
+
+    @staticmethod
+    def _parse_node(data, pos, ctype, header_size, size):
+        line, comment = struct.unpack_from("<II", data, pos + 8)
+        body = pos + header_size
+        if ctype in (RES_XML_START_NAMESPACE_TYPE, RES_XML_END_NAMESPACE_TYPE, RES_XML_END_ELEMENT_TYPE):
+            return Node(ctype, line, comment, list(struct.unpack_from("<II", data, body)))
+        if ctype == RES_XML_CDATA_TYPE:
+            text = struct.unpack_from("<I", data, body)[0]
+            typed = list(struct.unpack_from("<HBBI", data, body + 4))
+            return Node(ctype, line, comment, [text], typed=typed)
+        ns, name, attr_start, attr_size, attr_count, id_index, class_index, style_index = \
+            struct.unpack_from("<IIHHHHHH", data, body)
+        attrs = []
+        for i in range(attr_count):
+            a_ns, a_name, a_raw, _, _, a_type, a_data = struct.unpack_from(
+                "<IIIHBBI", data, body + attr_start + i * attr_size)
+            attrs.append(Attribute(a_ns, a_name, a_raw, a_type, a_data))
+        return Node(ctype, line, comment, [ns, name, id_index, class_index, style_index], attrs=attrs)
+
+    def to_bytes(self):
+        chunks = [self.pool.serialize()]
+        if self.resource_ids:
+            chunks.append(struct.pack("<HHI", RES_XML_RESOURCE_MAP_TYPE, 8, 8 + 4 * len(self.resource_ids))
+                          + struct.pack(f"<{len(self.resource_ids)}I", *self.resource_ids))
+        for node in self.nodes:
+            chunks.append(node.raw if node.raw is not None else self._serialize_node(node))
+        body = b"".join(chunks)
+        return struct.pack("<HHI", RES_XML_TYPE, 8, 8 + len(body)) + body
+
+    @staticmethod
+    def _serialize_node(node):
+        if node.type == RES_XML_START_ELEMENT_TYPE:
+            ns, name, id_index, class_index, style_index = node.fields
+            ext = struct.pack("<IIHHHHHH", ns, name, 20, 20, len(node.attrs), id_index, class_index, style_index)
+            ext += b"".join(struct.pack("<IIIHBBI", a.ns, a.name, a.raw_value, 8, 0, a.data_type, a.data)
+                            for a in node.attrs)
+        elif node.type == RES_XML_CDATA_TYPE:
+            ext = struct.pack("<I", node.fields[0]) + struct.pack("<HBBI", *node.typed)
+        else:
+            ext = struct.pack("<II", *node.fields)
+        return struct.pack("<HHIII", node.type, 16, 16 + len(ext), node.line, node.comment) + ext
+
+    def _shift_string_refs(self, start):
+        def shift(ref):
+            return ref + 1 if ref != NO_INDEX and ref >= start else ref
+        for node in self.nodes:
+            if node.raw is not None:
+                raise AxmlError(f"Unknown chunk {node.type:#06x} prevents string pool edits")
+            node.comment = shift(node.comment)
+            if node.type == RES_XML_START_ELEMENT_TYPE:
+                node.fields[0] = shift(node.fields[0])
+                node.fields[1] = shift(node.fields[1])
+                for a in node.attrs:
+                    a.ns = shift(a.ns)
+                    a.name = shift(a.name)
+                    a.raw_value = shift(a.raw_value)
+                    if a.data_type == TYPE_STRING:
+                        a.data = shift(a.data)
+            elif node.type == RES_XML_CDATA_TYPE:
+                node.fields[0] = shift(node.fields[0])
+                if node.typed[2] == TYPE_STRING:
+                    node.typed[3] = shift(node.typed[3])
+            else:
+                node.fields = [shift(f) for f in node.fields]
+
+    def string(self, ref):
+        return None if ref == NO_INDEX else self.pool[ref]
+
+    def elements(self, tag=None):
+        for node in self.nodes:
+            if node.type == RES_XML_START_ELEMENT_TYPE and (tag is None or self.string(node.fields[1]) == tag):
+                yield node
+
+    def attr_resource_id(self, attr):
+        return self.resource_ids[attr.name] if attr.name < len(self.resource_ids) else None
+
+    def find_attr(self, element, name=None, res_id=None):
+        for a in element.attrs:
+            if res_id is not None and self.attr_resource_id(a) == res_id:
+                return a
+            if res_id is None and name is not None and a.ns == NO_INDEX and self.string(a.name) == name:
+                return a
+        return None
+
+    def attr_value(self, attr):
+        if attr.data_type == TYPE_STRING:
+            return self.pool[attr.data]
+        if attr.raw_value != NO_INDEX:
+            return self.pool[attr.raw_value]
+        return attr.data
+
+    def _string_ref(self, value):
+        ref = self.pool.find(value)
+        # Strings inside the resource-map window are attribute names; keep values out of it.
+        if ref < len(self.resource_ids):
+            ref = self.pool.append(value)
+        return ref
+
+    def set_string(self, attr, value):
+        ref = self._string_ref(value)
+        attr.raw_value = ref
+        attr.data_type = TYPE_STRING
+        attr.data = ref
+
+    def set_bool(self, attr, value):
+        attr.raw_value = NO_INDEX
+        attr.data_type = TYPE_INT_BOOLEAN
+        attr.data = 0xFFFFFFFF if value else 0
+
+    def add_android_attr(self, element, name, res_id):
+        """Insert an android: attribute, keeping the attributes sorted by resource id."""
+        name_ref = next((i for i, rid in enumerate(self.resource_ids)
+                         if rid == res_id and self.pool[i] == name), None)
+        if name_ref is None:
+            name_ref = len(self.resource_ids)
+            self._shift_string_refs(name_ref)
+            self.pool.insert(name_ref, name)
+            self.resource_ids.append(res_id)
+        ns_ref = self.pool.find(ANDROID_NS)
+        if ns_ref < 0:
+            raise AxmlError("Manifest does not declare the android namespace")
+        attr = Attribute(ns_ref, name_ref, NO_INDEX, TYPE_INT_DEC, 0)
+        index = len(element.attrs)
+        for i, a in enumerate(element.attrs):
+            rid = self.attr_resource_id(a)
+            if rid is None or rid > res_id:
+                index = i
+                break
+        element.attrs.insert(index, attr)
+        # idIndex/classIndex/styleIndex are 1-based attribute positions.
+        for k in (2, 3, 4):
+            if element.fields[k] and element.fields[k] > index:
+                element.fields[k] += 1
+        return attr
+
+def _qualify(class_name, package):
+    if class_name.startswith("."):
+        return package + class_name
+    if "." not in class_name:
+        return package + "." + class_name
+    return class_name
+
+def label_references(data):
+    """Resource ids that android:label attributes point at."""
+    doc = AxmlDocument.parse(data)
+    ids = []
+    for element in doc.elements():
+        label = doc.find_attr(element, res_id=ATTR_LABEL)
+        if label is not None and label.data_type == TYPE_REFERENCE and label.data not in ids:
+            ids.append(label.data)
+    return ids
+
+def patch_manifest(data, package_name, app_name=None, extract_native_libs=True, keep_label_references=False):
+    """Binary counterpart of the text patch_manifest in the GUI scripts.
+
+    With keep_label_references, labels that point at a resource are left
+    alone because the caller rewrites that resource in resources.arsc.
+    """
+    doc = AxmlDocument.parse(data)
+    manifest = next(doc.elements("manifest"), None)
+    if manifest is None:
+        raise AxmlError("No <manifest> element")
+    package_attr = doc.find_attr(manifest, name="package")
+    if package_attr is None:
+        raise AxmlError("<manifest> has no package attribute")
+    old_package = doc.attr_value(package_attr)
+    # Relative class names resolve against the package; pin them before it changes.
+    for tag in COMPONENT_TAGS:
+        for element in doc.elements(tag):
+            for a in element.attrs:
+                if doc.attr_resource_id(a) in CLASS_NAME_ATTRS and a.data_type == TYPE_STRING:
+                    qualified = _qualify(doc.attr_value(a), old_package)
+                    if qualified != doc.attr_value(a):
+                        doc.set_string(a, qualified)
+    doc.set_string(package_attr, package_name)
+    if app_name is not None:
+        for element in doc.elements():
+            label = doc.find_attr(element, res_id=ATTR_LABEL)
+            if label is None or (keep_label_references and label.data_type == TYPE_REFERENCE):
+                continue
+            doc.set_string(label, app_name)
+    activity = next(doc.elements("activity"), None)
+    if activity is not None:
+        name = doc.find_attr(activity, res_id=ATTR_NAME)
+        if name is None:
+            name = doc.add_android_attr(activity, "name", ATTR_NAME)
+        doc.set_string(name, KR2_ACTIVITY)
+    application = next(doc.elements("application"), None)
+    if application is None:
+        raise AxmlError("No <application> element")
+    extract = doc.find_attr(application, res_id=ATTR_EXTRACT_NATIVE_LIBS)
+    if extract is None:
+        extract = doc.add_android_attr(application, "extractNativeLibs", ATTR_EXTRACT_NATIVE_LIBS)
+    doc.set_bool(extract, extract_native_libs)
+    return doc.to_bytes()
+
+def min_sdk_version(data):
+    doc = AxmlDocument.parse(data)
+    for element in doc.elements("uses-sdk"):
+        attr = doc.find_attr(element, res_id=ATTR_MIN_SDK_VERSION)
+        if attr is not None:
+            value = doc.attr_value(attr)
+            return int(value) if isinstance(value, str) and value.isdigit() else value
+    return 1
@@ -0,0 +1,199 @@
+"""Scratch disk use of a build: preflight, scratch volume choice, peak measurement and an optional budget.
+
+A build's scratch is its staging folder, with its temp folder inside, and
+the apktool workspace it uses, if any (ScratchMeter.add). The pipeline
+streams the game straight into the unsigned APK and signs that file in
+place, so scratch peaks at about the final APK plus the app shell. Files
+hardlinked from the caches are shared with them and are not counted.
+Before a build starts, that peak is estimated from a scan of the game
+folder and the first scratch root with room for it is picked.
+"""
+import logging
+import os
+import re
+import shutil
+import threading
+
+MiB = 1024 * 1024
+# Local header, central directory record and v1 manifest lines of one entry, rounded up.
+ENTRY_OVERHEAD = 512
+# v1 signature files and the APK Signing Block.
+SIGNING_OVERHEAD = 4 * MiB
+# Free space a build leaves on a volume for everything else that writes there.
+FREE_RESERVE = 256 * MiB
+SAMPLE_INTERVAL = 0.5
+_SIZE_UNITS = {"": 1, "k": 1024, "m": MiB, "g": 1024 * MiB, "t": 1024 * 1024 * MiB}
+
+class DiskBudgetError(Exception):
+    pass
+
+def _mib(n):
+    return f"{n / MiB:.0f} MiB"
+
+def parse_size(text):
+    """Bytes of a size such as 8G, 500M or 123456."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)[iI]?[bB]?\s*", text)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+def budget_from_args(argv):
+    """The --disk-budget=SIZE option, None without it."""
+    for arg in argv:
+        if arg.startswith("--disk-budget="):
+            return parse_size(arg.split("=", 1)[1])
+    return None
+
+def scratch_roots_from_args(argv, defaults):
+    """The --scratch-root=PATH options in order of preference, defaults without any."""
+    roots = [os.path.abspath(arg.split("=", 1)[1]) for arg in argv if arg.startswith("--scratch-root=")]
+    return roots or list(defaults)
+
+def folder_stats(path):
+    """Return (files, bytes) of the files under path."""
+    files = total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+            files += 1
+    return files, total
+
+def apk_estimate(game_files, game_bytes, *inputs):
+    """Upper bound of the unsigned APK built from the game folder and the zip inputs (shell, overlay)."""
+    return game_bytes + game_files * ENTRY_OVERHEAD + sum(os.path.getsize(path) for path in inputs)
+
+def build_estimate(game_files, game_bytes, base_apk):
+    """Return (peak scratch, output) bytes of a build: the signed APK next to the
+    apktool-rebuilt shell, and the published APK."""
+    apk = apk_estimate(game_files, game_bytes, base_apk) + SIGNING_OVERHEAD
+    return apk + os.path.getsize(base_apk), apk
+
+def choose_scratch_root(roots, scratch, output_dir, output):
+    """First of roots with scratch bytes free, and output bytes free in output_dir
+    when the root is on another volume (the APK is copied over to publish it).
+
+    On the output volume the APK is renamed into place, so its bytes are
+    already part of scratch. Raises DiskBudgetError with the estimate when no
+    root fits.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_dev = os.stat(output_dir).st_dev
+    output_free = shutil.disk_usage(output_dir).free
+    tried = []
+    for root in roots:
+        try:
+            os.makedirs(root, exist_ok=True)
+            free = shutil.disk_usage(root).free
+            same_volume = os.stat(root).st_dev == output_dev
+        except OSError as e:
+            tried.append(f"{root}: {e}")
+            continue
+        tried.append(f"{root}: {_mib(free)} free")
+        if free >= scratch + FREE_RESERVE and (same_volume or output_free >= output + FREE_RESERVE):
+            logging.info(f"Scratch root {root} ({_mib(free)} free) for about {_mib(scratch)} of scratch "
+                         f"and {_mib(output)} of output")
+            return root
+    raise DiskBudgetError(f"Not enough free disk space: the build needs about {_mib(scratch)} of scratch and "
+                          f"{_mib(output)} of output ({_mib(output_free)} free in {output_dir}).\n" + "\n".join(tried))
+
+def preflight(game_dir, base_apk, roots, output_dir, budget=None):
+    """Scan the game folder and pick the scratch root before any work is done.
+
+    Returns (scratch root, game files, game bytes); raises DiskBudgetError
+    when the estimate is over budget or fits no root.
+    """
+    game_files, game_bytes = folder_stats(game_dir)
+    scratch, output = build_estimate(game_files, game_bytes, base_apk)
+    if budget is not None and scratch > budget:
+        raise DiskBudgetError(f"The build needs about {_mib(scratch)} of scratch space for "
+                              f"{game_files} game files ({_mib(game_bytes)}), but the disk budget is {_mib(budget)}")
+    return choose_scratch_root(roots, scratch, output_dir, output), game_files, game_bytes
+
+def scratch_bytes(paths):
+    """Bytes of the files under paths that are not hardlinks to files elsewhere."""
+    total = 0
+    for path in paths:
+        for root, _, names in os.walk(path):
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if st.st_nlink == 1:
+                    total += st.st_size
+    return total
+
+class ScratchMeter:
+    """Sample the scratch folders of a build, keep the peak and hold them to budget (bytes or None)."""
+
+    def __init__(self, paths=(), budget=None, interval=SAMPLE_INTERVAL):
+        self.paths = list(paths)
+        self.budget = budget
+        self.interval = interval
+        self.current = 0
+        self.peak = 0
+        self.overrun = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, path):
+        with self._lock:
+            self.paths.append(path)
+
+    def sample(self):
+        with self._lock:
+            paths = list(self.paths)
+        self.current = scratch_bytes(paths)
+        self.peak = max(self.peak, self.current)
+        if self.budget is not None and self.current > self.budget and self.current > self.overrun:
+            if not self.overrun:
+                logging.warning(f"Scratch use {_mib(self.current)} is over the disk budget of {_mib(self.budget)}")
+            self.overrun = self.current
+        return self.current
+
+    def require(self, nbytes, what):
+        """Fail before a step that will add about nbytes of scratch if they do not fit the budget."""
+        if self.budget is None:
+            return
+        in_use = self.sample()
+        if in_use + nbytes > self.budget:
+            raise DiskBudgetError(f"{what} needs about {_mib(nbytes)} of scratch space next to {_mib(in_use)} "
+                                  f"in use, but the disk budget is {_mib(self.budget)}")
+
+    def check(self):
+        """Fail if scratch has gone over the budget at any sample so far."""
+        self.sample()
+        if self.overrun:
+            raise DiskBudgetError(f"Scratch use reached {_mib(self.overrun)}, over the disk budget of {_mib(self.budget)}")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._loop, name="scratch-meter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and log the peak; call it before the scratch folders are removed."""
+        if self._thread is None:
+            return self.peak
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.sample()
+        budget = f", budget {_mib(self.budget)}" if self.budget is not None else ""
+        logging.info(f"Peak scratch: {self.peak} bytes ({_mib(self.peak)}{budget})")
+        return self.peak
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
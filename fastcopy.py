@@ -0,0 +1,134 @@
+"""File copies that avoid moving bytes: hardlink, reflink, copy_file_range, then a plain copy."""
+import errno
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+COPY_FILE_RANGE = "copy_file_range"
+COPY = "copy"
+METHODS = (HARDLINK, REFLINK, COPY_FILE_RANGE, COPY)
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+_RANGE_CHUNK = 64 * 1024 * 1024
+# Errors that only mean "this method is not available here"; anything else is real.
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                errno.ENOSYS, errno.EMLINK, errno.EACCES}
+
+class CopyStats:
+    """Files and bytes per copy method, so a build can log the I/O it avoided."""
+
+    def __init__(self):
+        self.files = dict.fromkeys(METHODS, 0)
+        self.bytes = dict.fromkeys(METHODS, 0)
+
+    def add(self, method, size):
+        self.files[method] += 1
+        self.bytes[method] += size
+
+    def saved_bytes(self):
+        # Hardlinks and reflinks write no data; copy_file_range stays in the kernel.
+        return self.bytes[HARDLINK] + self.bytes[REFLINK]
+
+    def summary(self):
+        parts = [f"{method} {self.files[method]} ({self.bytes[method]} bytes)"
+                 for method in METHODS if self.files[method]]
+        return ", ".join(parts) or "nothing"
+
+    def log(self, what):
+        logging.info(f"{what}: {self.summary()}; {self.saved_bytes()} bytes not rewritten")
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    os.remove(dst)
+    return False
+
+def _data_segments(fd, size):
+    """Yield (offset, length) of the data regions of a possibly sparse file."""
+    if not hasattr(os, "SEEK_DATA"):
+        yield 0, size
+        return
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            yield pos, size - pos
+            return
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end - start
+        pos = end
+
+def _copy_range(src, dst, size):
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            complete = True
+            for start, length in _data_segments(fsrc.fileno(), size):
+                offset = start
+                end = start + length
+                while offset < end:
+                    done = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(_RANGE_CHUNK, end - offset),
+                                              offset, offset)
+                    if done == 0:
+                        # The source shrank, or the filesystem (FUSE, /proc) does not really
+                        # support the call; a plain copy sorts out which.
+                        complete = False
+                        break
+                    offset += done
+                if not complete:
+                    break
+            if complete:
+                # Holes are left unwritten; truncate restores the full length.
+                os.ftruncate(fdst.fileno(), size)
+                return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    os.remove(dst)
+    return False
+
+def copy_file(src, dst, allow_link=True, stats=None):
+    """Copy src to dst with the cheapest method that works and return its name.
+
+    allow_link=False is for files the caller will modify: a hardlink would
+    let those writes reach src, a reflink or a real copy does not.
+    """
+    size = os.path.getsize(src)
+    method = COPY
+    if allow_link:
+        try:
+            os.link(src, dst)
+            method = HARDLINK
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+    if method == COPY:
+        if _reflink(src, dst):
+            method = REFLINK
+        elif _copy_range(src, dst, size):
+            method = COPY_FILE_RANGE
+        else:
+            shutil.copyfile(src, dst)
+        shutil.copystat(src, dst)
+    if stats is not None:
+        stats.add(method, size)
+    return method
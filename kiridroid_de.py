@@ -4,13 +4,22 @@ import subprocess
 import tempfile
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-import zipfile
 import sys
 import threading
 import queue
 import logging
 import re
 from PIL import Image
+import apkcache
+import apksign
+import apkverify
+import apkzip
+import diskplan
+import memplan
+import shellpatch
+import staging
+import toolchain
+import tooldaemon
 
 def play_sound(filename):
     try:
@@ -27,39 +36,41 @@ if not os.path.exists(JAVA_BIN):
     raise RuntimeError(f"Eingebettetes Java nicht gefunden: {JAVA_BIN}")
 
 def find_apksigner():
-    apksigner_bat = os.path.join(BUILD_TOOLS, "35.0.1", "apksigner.bat")
-    apksigner_jar = os.path.join(BUILD_TOOLS, "35.0.1", "lib", "apksigner.jar")
-    if os.path.exists(apksigner_bat):
-        return apksigner_bat
-    elif os.path.exists(apksigner_jar):
-        return apksigner_jar
-    apksigner_bat = os.path.join(BUILD_TOOLS, "36.0.0", "apksigner.bat")
-    apksigner_jar = os.path.join(BUILD_TOOLS, "36.0.0", "lib", "apksigner.jar")
-    if os.path.exists(apksigner_bat):
-        return apksigner_bat
-    elif os.path.exists(apksigner_jar):
-        return apksigner_jar
-    apksigner_bat = os.path.join(BUILD_TOOLS, "apksigner.bat")
-    apksigner_jar = os.path.join(BUILD_TOOLS, "apksigner.jar")
-    if os.path.exists(apksigner_bat):
-        return apksigner_bat
-    elif os.path.exists(apksigner_jar):
-        return apksigner_jar
+    # The jar comes first: it can run in the tool daemon, the .bat cannot.
+    for folder in (os.path.join(BUILD_TOOLS, "35.0.1", "lib"), os.path.join(BUILD_TOOLS, "36.0.0", "lib"), BUILD_TOOLS):
+        apksigner_jar = os.path.join(folder, "apksigner.jar")
+        if os.path.exists(apksigner_jar):
+            return apksigner_jar
+    for folder in (os.path.join(BUILD_TOOLS, "35.0.1"), os.path.join(BUILD_TOOLS, "36.0.0"), BUILD_TOOLS):
+        apksigner_bat = os.path.join(folder, "apksigner.bat")
+        if os.path.exists(apksigner_bat):
+            return apksigner_bat
     return None
 
-APKSIGNER = find_apksigner()
+def resolve_toolchain():
+    # Resolved per job, so a build-tools change is picked up without a restart.
+    return toolchain.Toolchain(JAVA_BIN, APKTOOL_JAR, find_apksigner())
+
 OUTPUT_DIR = os.path.abspath("output")
 KEYSTORE = os.path.abspath("testkey.jks")
 KEY_ALIAS = "testkey"
 KEY_PASS = "123456"
+# --paranoid rereads and inflates the whole signed APK instead of checking it
+# against what the writer recorded.
+PARANOID = "--paranoid" in sys.argv
+# --disk-budget=SIZE (e.g. 12G) fails a build whose scratch files would grow past SIZE.
+DISK_BUDGET = diskplan.budget_from_args(sys.argv)
+# --scratch-root=PATH (repeatable, in order of preference) lists volumes for a
+# build's scratch files; the first with room for the estimate is used.
+SCRATCH_ROOTS = diskplan.scratch_roots_from_args(sys.argv, [OUTPUT_DIR, tempfile.gettempdir()])
 
-def ensure_keystore(progress, status):
+def ensure_keystore(progress, status, tools):
     if not os.path.exists(KEYSTORE):
         status.set("Erstelle Keystore...")
         progress.step(10)
         progress.update()
         cmd = [
-            "keytool", "-genkeypair", "-v",
+            tools.which("keytool"), "-genkeypair", "-v",
             "-keystore", KEYSTORE,
             "-alias", KEY_ALIAS,
             "-keyalg", "RSA",
@@ -69,7 +80,7 @@ def ensure_keystore(progress, status):
             "-keypass", KEY_PASS,
             "-dname", "CN=Test,OU=Test,O=Test,L=Test,ST=Test,C=CN"
         ]
-        subprocess.run(cmd, check=True)
+        tools.run(cmd, check=True)
 
 def patch_manifest(manifest_path, package_name, app_name):
     with open(manifest_path, "r", encoding="utf-8") as f:
@@ -103,15 +114,6 @@ def replace_icon(res_dir, icon_path):
         os.makedirs(mipmap_dir)
     shutil.copy(icon_path, os.path.join(mipmap_dir, "ic_launcher.png"))
 
-def copy_game_assets(game_dir, assets_dir):
-    if os.path.exists(assets_dir):
-        shutil.rmtree(assets_dir)
-    shutil.copytree(game_dir, assets_dir)
-    data_xp3 = os.path.join(assets_dir, "data.xp3")
-    gameexe_dat = os.path.join(assets_dir, "gameexe.dat")
-    if os.path.exists(data_xp3) and not os.path.exists(gameexe_dat):
-        shutil.copyfile(data_xp3, gameexe_dat)
-
 logging.basicConfig(filename='log.txt', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 class UIUpdater:
@@ -142,8 +144,11 @@ class UIUpdater:
 
 def check_apktool_version():
     try:
-        cmd = [JAVA_BIN, "-jar", APKTOOL_JAR, "--version"]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        # Sized like the decode that follows, so this check starts the daemon it uses.
+        tools = resolve_toolchain()
+        heap = memplan.heap_args(memplan.APKTOOL_DECODE, os.path.getsize(KIRIKIRI_APK))
+        cmd = [tools.java_bin, *heap, "-jar", tools.apktool_jar, "--version"]
+        result = tooldaemon.run_java(cmd, text=True, timeout=10, env=tools.env)
         if result.returncode == 0:
             return result.stdout.strip()
         else:
@@ -182,130 +187,127 @@ def replace_launcher_icons(res_dir, user_icon_path):
     return replaced
 
 def build_apk_thread(game_dir, icon_path, package_name, app_name, ui_updater, progress_max=100):
-    original_java_home = os.environ.get('JAVA_HOME')
-    original_path = os.environ.get('PATH')
-    openjdk_dir = os.path.abspath('openjdk-21.0.7.6-hotspot')
-    os.environ['JAVA_HOME'] = openjdk_dir
-    os.environ['PATH'] = os.path.join(openjdk_dir, 'bin') + os.pathsep + (original_path or '')
+    tools = resolve_toolchain()
     tmpdirs = []
+    reservation = None
+    job_staging = None
+    workspace = None
+    meter = None
     try:
+        ui_updater.set_status("Freier Speicherplatz wird geprüft...")
+        scratch_root, game_files, game_bytes = diskplan.preflight(game_dir, KIRIKIRI_APK, SCRATCH_ROOTS, OUTPUT_DIR, DISK_BUDGET)
+        build_input = game_bytes + os.path.getsize(KIRIKIRI_APK)
+        reservation = memplan.admit(memplan.BUILD, build_input,
+                                    waiting=lambda *_: ui_updater.set_status("Warte auf freien Arbeitsspeicher..."))
         ui_updater.set_status("Erstelle Keystore...")
         ui_updater.set_progress(0)
-        ensure_keystore(ui_updater, ui_updater)
+        ensure_keystore(ui_updater, ui_updater, tools)
         if not os.path.exists(OUTPUT_DIR):
             os.makedirs(OUTPUT_DIR)
-        with tempfile.TemporaryDirectory() as tmpdir:
+        # The APK is built, signed and checked in this job's own folder on the
+        # scratch volume, then published atomically.
+        job_staging = staging.JobStaging(OUTPUT_DIR, scratch_root)
+        with tempfile.TemporaryDirectory(dir=job_staging.path) as tmpdir:
             tmpdirs.append(tmpdir)
-            ui_updater.set_status("Dekompiliere APK...")
-            ui_updater.step_progress(10)
-            decompiled_dir = os.path.join(tmpdir, "kirikiroid2")
-            cmd = [JAVA_BIN, "-Xmx4g", "-jar", APKTOOL_JAR, "d", "-f", KIRIKIRI_APK, "-o", decompiled_dir]
-            logging.info(f"Dekomplilier-Befehl: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True)
-            logging.info(f"Dekomplilier-Ergebnis: {result.stdout}\nFehler: {result.stderr}")
-            if result.returncode != 0:
-                play_sound("error.wav")
-                ui_updater.show_error("Fehler", "Fehler beim Dekomplieren mit apktool!\n" + result.stderr.decode("utf-8", errors="ignore"))
-                ui_updater.set_status("Dekomplieren fehlgeschlagen")
-                ui_updater.enable_btn()
-                return
-            ui_updater.set_status("Kopiere Spieldateien...")
-            ui_updater.step_progress(15)
-            assets_dir = os.path.join(decompiled_dir, "assets")
-            copy_game_assets(game_dir, assets_dir)
-            ui_updater.set_status("Ersetze Icons...")
-            ui_updater.step_progress(10)
-            res_dir = os.path.join(decompiled_dir, "res")
-            try:
-                replaced = replace_launcher_icons(res_dir, icon_path)
-                logging.info(f"{replaced} ic_launcher.png ersetzt")
-            except Exception as e:
-                play_sound("error.wav")
-                ui_updater.show_error("Fehler", f"Fehler beim Ersetzen des Icons: {e}")
-                ui_updater.set_status("Fehler beim Icon-Austausch")
-                ui_updater.enable_btn()
-                return
+            meter = diskplan.ScratchMeter([job_staging.path], DISK_BUDGET).start()
+            rebuilt_apk = job_staging.file("rebuilt.apk")
+            shell_apk = KIRIKIRI_APK
             ui_updater.set_status("Paketname und App-Name ändern...")
-            ui_updater.step_progress(10)
-            manifest_path = os.path.join(decompiled_dir, "AndroidManifest.xml")
-            patch_manifest(manifest_path, package_name, app_name)
-            ui_updater.set_status("Baue APK neu...")
-            ui_updater.step_progress(20)
-            rebuilt_apk = os.path.join(tmpdir, "rebuilt.apk")
-            cmd = [JAVA_BIN, "-Xmx4g", "-jar", APKTOOL_JAR, "b", decompiled_dir, "-o", rebuilt_apk]
-            logging.info(f"Neubau-Befehl: {' '.join(cmd)}")
-            result = subprocess.run(cmd, capture_output=True)
-            logging.info(f"Neubau-Ergebnis: {result.stdout}\nFehler: {result.stderr}")
-            if result.returncode != 0:
-                play_sound("error.wav")
-                ui_updater.show_error("Fehler", "Fehler beim Neubauen mit apktool!\n" + result.stderr.decode("utf-8", errors="ignore"))
-                ui_updater.set_status("Neubau fehlgeschlagen")
-                ui_updater.enable_btn()
-                return
             try:
-                SEVEN_ZIP = os.path.abspath(os.path.join(os.path.dirname(__file__), "7-Zip", "7z.exe"))
-                with tempfile.TemporaryDirectory() as tmpdir_a, tempfile.TemporaryDirectory() as tmpdir_b:
-                    with zipfile.ZipFile(rebuilt_apk, 'r') as zin:
-                        zin.extractall(tmpdir_a)
-                    with zipfile.ZipFile(KIRIKIRI_APK, 'r') as zin:
-                        zin.extractall(tmpdir_b)
-                    for fname in os.listdir(tmpdir_b):
-                        if fname.startswith('classes') and fname.endswith('.dex'):
-                            shutil.copy(os.path.join(tmpdir_b, fname), os.path.join(tmpdir_a, fname))
-                    tmp_new_apk = rebuilt_apk + ".tmp"
-                    result = subprocess.run([SEVEN_ZIP, 'a', '-tzip', tmp_new_apk, '.'], cwd=tmpdir_a, capture_output=True)
-                    if result.returncode != 0:
-                        raise Exception(f"7z-Neubau-Fehler: {result.stderr.decode('utf-8', errors='ignore')}")
-                    os.replace(tmp_new_apk, rebuilt_apk)
-                logging.info("DEX mit 7z erfolgreich ersetzt")
-            except Exception as e:
-                logging.error(f"Fehler beim Kopieren von DEX: {e}")
-                ui_updater.show_error("Fehler", f"Fehler beim Kopieren von DEX: {e}")
-                ui_updater.set_status("Fehler beim Kopieren von DEX")
-                ui_updater.enable_btn()
-                return
+                shell_overrides = shellpatch.direct_shell_overrides(KIRIKIRI_APK, icon_path, package_name, app_name)
+                ui_updater.step_progress(50)
+            except shellpatch.ShellPatchError as e:
+                logging.info(f"Binäres Patchen der App-Hülle nicht möglich, weiche auf apktool aus: {e}")
+                shell_overrides = None
+            if shell_overrides is None:
+                shell_overrides = {}
+                shell_apk = rebuilt_apk
+                ui_updater.set_status("Dekompiliere APK...")
+                ui_updater.step_progress(10)
+                # The decoded tree persists per package so apktool can reuse its build/ folder.
+                workspace = apkcache.Workspace.acquire(KIRIKIRI_APK, tools.apktool_jar, package_name, apkcache.DECODE_NO_SOURCES)
+                decompiled_dir = workspace.tree if workspace is not None else os.path.join(tmpdir, "kirikiroid2")
+                if workspace is not None:
+                    # apktool writes its build/ output into the workspace, outside staging.
+                    meter.add(workspace.tree)
+                # A framework folder of its own keeps parallel builds from racing on apktool's shared one.
+                apktool_args = apkcache.apktool_job_args(apkcache.job_framework(tools.apktool_jar, tmpdir), reservation.workers)
+                try:
+                    if workspace is None or not workspace.reset():
+                        apkcache.decode_base_apk(tools.java_bin, tools.apktool_jar, KIRIKIRI_APK, decompiled_dir,
+                                                 apkcache.DECODE_NO_SOURCES, apktool_args, tools.env)
+                except subprocess.CalledProcessError as e:
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", "Fehler beim Dekomplieren mit apktool!\n" + e.stderr.decode("utf-8", errors="ignore"))
+                    ui_updater.set_status("Dekomplieren fehlgeschlagen")
+                    ui_updater.enable_btn()
+                    return
+                # apktool only rebuilds the app shell; game assets are streamed in afterwards.
+                shutil.rmtree(os.path.join(decompiled_dir, "assets"), ignore_errors=True)
+                ui_updater.set_status("Ersetze Icons...")
+                ui_updater.step_progress(10)
+                res_dir = os.path.join(decompiled_dir, "res")
+                try:
+                    replaced = replace_launcher_icons(res_dir, icon_path)
+                    logging.info(f"{replaced} ic_launcher.png ersetzt")
+                except Exception as e:
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", f"Fehler beim Ersetzen des Icons: {e}")
+                    ui_updater.set_status("Fehler beim Icon-Austausch")
+                    ui_updater.enable_btn()
+                    return
+                ui_updater.set_status("Paketname und App-Name ändern...")
+                ui_updater.step_progress(10)
+                manifest_path = os.path.join(decompiled_dir, "AndroidManifest.xml")
+                patch_manifest(manifest_path, package_name, app_name)
+                if workspace is not None:
+                    workspace.settle()
+                ui_updater.set_status("Baue APK neu...")
+                ui_updater.step_progress(20)
+                decoded_size = memplan.tree_size(decompiled_dir)
+                heap = memplan.heap_args(memplan.APKTOOL_BUILD, decoded_size)
+                cmd = [tools.java_bin, *heap, "-jar", tools.apktool_jar, "b", *apktool_args, decompiled_dir, "-o", rebuilt_apk]
+                logging.info(f"Neubau-Befehl: {' '.join(cmd)}")
+                result = tooldaemon.run_java(cmd, kind=memplan.APKTOOL_BUILD, input_bytes=decoded_size, env=tools.env)
+                logging.info(f"Neubau-Ergebnis: {result.stdout}\nFehler: {result.stderr}")
+                if result.returncode != 0:
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", "Fehler beim Neubauen mit apktool!\n" + result.stderr.decode("utf-8", errors="ignore"))
+                    ui_updater.set_status("Neubau fehlgeschlagen")
+                    ui_updater.enable_btn()
+                    return
+            abi_map = {
+                "armeabi-v7a": os.path.abspath("libc++_shared/32/libc++_shared.so"),
+                "arm64-v8a": os.path.abspath("libc++_shared/64/libc++_shared.so")
+            }
+            for abi, so_src in abi_map.items():
+                if not os.path.exists(so_src):
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", f"{so_src} nicht gefunden, bitte stellen Sie sicher, dass libc++_shared.so für 32/64 Bit vorhanden ist")
+                    ui_updater.set_status(f"libc++_shared.so für {abi} fehlt")
+                    ui_updater.enable_btn()
+                    return
+            ui_updater.set_status("Kopiere Spieldateien...")
+            ui_updater.step_progress(15)
             try:
-                with tempfile.TemporaryDirectory() as tmpdir_c:
-                    with zipfile.ZipFile(rebuilt_apk, 'r') as zin:
-                        zin.extractall(tmpdir_c)
-                    lib_dir = os.path.join(tmpdir_c, "lib")
-                    abi_map = {
-                        "armeabi-v7a": os.path.abspath("libc++_shared/32/libc++_shared.so"),
-                        "arm64-v8a": os.path.abspath("libc++_shared/64/libc++_shared.so")
-                    }
-                    for abi, so_src in abi_map.items():
-                        abi_path = os.path.join(lib_dir, abi)
-                        if not os.path.exists(so_src):
-                            play_sound("error.wav")
-                            ui_updater.show_error("Fehler", f"{so_src} nicht gefunden, bitte stellen Sie sicher, dass libc++_shared.so für 32/64 Bit vorhanden ist")
-                            ui_updater.set_status(f"libc++_shared.so für {abi} fehlt")
-                            ui_updater.enable_btn()
-                            return
-                        if not os.path.exists(abi_path):
-                            os.makedirs(abi_path)
-                        shutil.copy(so_src, os.path.join(abi_path, "libc++_shared.so"))
-                    for abi in abi_map.keys():
-                        so_path = os.path.join(lib_dir, abi, "libc++_shared.so")
-                        if not os.path.exists(so_path):
-                            play_sound("error.wav")
-                            ui_updater.show_error("Fehler", f"libc++_shared.so fehlt im ABI-Verzeichnis {abi}, Verpackung abgebrochen!")
-                            ui_updater.set_status("libc++_shared.so fehlt im ABI")
-                            ui_updater.enable_btn()
-                            return
-                    tmp_new_apk2 = rebuilt_apk + ".tmp2"
-                    result = subprocess.run([SEVEN_ZIP, 'a', '-tzip', tmp_new_apk2, '.'], cwd=tmpdir_c, capture_output=True)
-                    if result.returncode != 0:
-                        raise Exception(f"7z-Neubau-Fehler: {result.stderr.decode('utf-8', errors='ignore')}")
-                    os.replace(tmp_new_apk2, rebuilt_apk)
+                tmp_new_apk = rebuilt_apk + ".tmp"
+                overlay = apkcache.overlay_bundle(KIRIKIRI_APK, abi_map, apkzip.shell_lib_compress(shell_apk))
+                meter.require(diskplan.apk_estimate(game_files, game_bytes, shell_apk, overlay), "Assembling the APK")
+                layout = apkzip.assemble_apk(tmp_new_apk, shell_apk, overlay, game_dir, shell_overrides, reservation.workers)
+                os.replace(tmp_new_apk, rebuilt_apk)
+                meter.check()
+            except diskplan.DiskBudgetError:
+                raise
             except Exception as e:
-                logging.error(f"Fehler bei libc++_shared.so: {e}")
-                ui_updater.show_error("Fehler", f"Fehler bei libc++_shared.so: {e}")
-                ui_updater.set_status("Fehler bei libc++_shared.so")
+                logging.error(f"APK-Zusammenstellung fehlgeschlagen: {e}")
+                ui_updater.show_error("Fehler", f"APK-Zusammenstellung fehlgeschlagen: {e}")
+                ui_updater.set_status("APK-Zusammenstellung fehlgeschlagen")
                 ui_updater.enable_btn()
                 return
             ui_updater.set_status("Signiere APK...")
             ui_updater.step_progress(20)
             signed_apk = os.path.join(OUTPUT_DIR, f"{app_name}_signed.apk")
+            staged_apk = job_staging.file("signed.apk")
             if not os.path.exists(rebuilt_apk):
                 play_sound("error.wav")
                 ui_updater.show_error("Fehler", f"Neu gebautes APK nicht gefunden: {rebuilt_apk}")
@@ -319,58 +321,80 @@ def build_apk_thread(game_dir, icon_path, package_name, app_name, ui_updater, pr
                 ui_updater.set_status("Neu gebautes APK beschädigt")
                 ui_updater.enable_btn()
                 return
-            if APKSIGNER is None:
-                play_sound("error.wav")
-                ui_updater.show_error("Fehler", "apksigner-Tool nicht gefunden! Bitte prüfen Sie den build-tools-Ordner.")
-                ui_updater.set_status("apksigner nicht gefunden")
-                ui_updater.enable_btn()
-                return
-            if APKSIGNER.endswith(".bat"):
-                bat_path = APKSIGNER
-                sign_args = [
-                    "sign",
-                    "--ks", KEYSTORE,
-                    "--ks-key-alias", KEY_ALIAS,
-                    "--ks-pass", f"pass:{KEY_PASS}",
-                    "--key-pass", f"pass:{KEY_PASS}",
-                    "--out", signed_apk,
-                    rebuilt_apk
-                ]
-                cmd = ["cmd", "/c", bat_path] + sign_args
-                env = os.environ.copy()
-                env["JAVA_HOME"] = os.path.abspath("openjdk-21.0.7.6-hotspot")
-                env["PATH"] = os.path.dirname(JAVA_BIN) + os.pathsep + env.get("PATH", "")
-                result = subprocess.run(cmd, capture_output=True, text=True, env=env)
-                logging.info(f"Signier-Befehl: {' '.join(cmd)}")
-            else:
-                cmd = [JAVA_BIN, "-Xmx4g", "-jar", APKSIGNER, "sign", "--ks", KEYSTORE, "--ks-key-alias", KEY_ALIAS, "--ks-pass", f"pass:{KEY_PASS}", "--key-pass", f"pass:{KEY_PASS}", "--out", signed_apk, rebuilt_apk]
-                result = subprocess.run(cmd, capture_output=True, text=True)
-                logging.info(f"Signier-Befehl: {' '.join(cmd)}")
-            if result.returncode != 0:
-                play_sound("error.wav")
-                error_msg = f"Signierfehler!\nRückgabecode: {result.returncode}\nFehler: {result.stderr}"
-                ui_updater.show_error("Fehler", error_msg)
-                ui_updater.set_status("Signierfehler")
-                ui_updater.enable_btn()
-                return
+            signed_in_process = False
+            signed_layout = None
+            if apksign.available():
+                try:
+                    signer = apksign.load_signer(KEYSTORE, KEY_ALIAS, KEY_PASS, KEY_PASS)
+                    signed_layout = apksign.sign_apk(rebuilt_apk, signer, workers=reservation.workers, layout=layout)
+                    os.replace(rebuilt_apk, staged_apk)
+                    signed_in_process = True
+                except apksign.ApkTooLargeError as e:
+                    # apksigner rejects zip64 APKs too, so there is nothing to fall back to.
+                    logging.error(str(e))
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", f"APK ist zu groß zum Signieren: {e}")
+                    ui_updater.set_status("APK zu groß zum Signieren")
+                    ui_updater.enable_btn()
+                    return
+                except apksign.ApkSignError as e:
+                    logging.info(f"Signieren im Prozess nicht möglich, weiche auf apksigner aus: {e}")
+            if not signed_in_process:
+                if tools.apksigner is None:
+                    play_sound("error.wav")
+                    ui_updater.show_error("Fehler", "apksigner-Tool nicht gefunden! Bitte prüfen Sie den build-tools-Ordner.")
+                    ui_updater.set_status("apksigner nicht gefunden")
+                    ui_updater.enable_btn()
+                    return
+                # apksigner writes a signed copy next to its input instead of signing in place.
+                meter.require(rebuilt_size + diskplan.SIGNING_OVERHEAD, "Signing with apksigner")
+                if tools.apksigner.endswith(".bat"):
+                    bat_path = tools.apksigner
+                    sign_args = [
+                        "sign",
+                        "--ks", KEYSTORE,
+                        "--ks-key-alias", KEY_ALIAS,
+                        "--ks-pass", f"pass:{KEY_PASS}",
+                        "--key-pass", f"pass:{KEY_PASS}",
+                        "--out", staged_apk,
+                        rebuilt_apk
+                    ]
+                    cmd = ["cmd", "/c", bat_path] + sign_args
+                    result = tools.run(cmd, capture_output=True, text=True)
+                    logging.info(f"Signier-Befehl: {' '.join(cmd)}")
+                else:
+                    heap = memplan.heap_args(memplan.APKSIGNER, rebuilt_size)
+                    cmd = [tools.java_bin, *heap, "-jar", tools.apksigner, "sign", "--ks", KEYSTORE, "--ks-key-alias", KEY_ALIAS, "--ks-pass", f"pass:{KEY_PASS}", "--key-pass", f"pass:{KEY_PASS}", "--out", staged_apk, rebuilt_apk]
+                    result = tooldaemon.run_java(cmd, text=True, kind=memplan.APKSIGNER, input_bytes=rebuilt_size, env=tools.env)
+                    logging.info(f"Signier-Befehl: {' '.join(cmd)}")
+                if result.returncode != 0:
+                    play_sound("error.wav")
+                    error_msg = f"Signierfehler!\nRückgabecode: {result.returncode}\nFehler: {result.stderr}"
+                    ui_updater.show_error("Fehler", error_msg)
+                    ui_updater.set_status("Signierfehler")
+                    ui_updater.enable_btn()
+                    return
             ui_updater.step_progress(10)
-            if not os.path.exists(signed_apk):
+            if not os.path.exists(staged_apk):
                 play_sound("error.wav")
                 ui_updater.show_error("Fehler", "Signiertes APK wurde nicht erstellt!")
                 ui_updater.set_status("Signiertes APK fehlt")
                 ui_updater.enable_btn()
                 return
             try:
-                with zipfile.ZipFile(signed_apk, 'r') as zf:
-                    test = zf.testzip()
-                    if test is not None:
-                        raise Exception(f"APK-Archiv beschädigt: {test}")
+                verified = apkverify.verify_apk(staged_apk, workers=reservation.workers, layout=signed_layout, paranoid=PARANOID)
+                logging.info(verified.summary())
+                if not verified.ok:
+                    problems = "; ".join(verified.errors)
+                    raise Exception(f"APK-Archiv beschädigt: {problems}")
             except Exception as e:
                 play_sound("error.wav")
                 ui_updater.show_error("Fehler", f"Integritätsprüfung des signierten APK fehlgeschlagen: {e}")
                 ui_updater.set_status("APK-Prüfung fehlgeschlagen")
                 ui_updater.enable_btn()
                 return
+            meter.check()
+            job_staging.publish(staged_apk, signed_apk)
             ui_updater.set_status("Fertig!")
             play_sound("finish.wav")
             ui_updater.show_info("Erfolg", f"APK-Verpackung abgeschlossen!\nDatei: {signed_apk}")
@@ -380,16 +404,12 @@ def build_apk_thread(game_dir, icon_path, package_name, app_name, ui_updater, pr
                 subprocess.Popen(f'explorer "{output_dir}"')
             except Exception as e:
                 logging.warning(f"Konnte output-Ordner nicht öffnen: {e}")
-            for fname in os.listdir(OUTPUT_DIR):
-                if not fname.endswith(".apk"):
-                    fpath = os.path.join(OUTPUT_DIR, fname)
-                    try:
-                        if os.path.isdir(fpath):
-                            shutil.rmtree(fpath)
-                        else:
-                            os.remove(fpath)
-                    except Exception as e:
-                        logging.warning(f"Konnte temporäre Datei nicht löschen: {fpath}, {e}")
+    except diskplan.DiskBudgetError as e:
+        logging.error(str(e))
+        ui_updater.set_status("Nicht genügend Speicherplatz")
+        play_sound("error.wav")
+        ui_updater.show_error("Fehler", str(e))
+        ui_updater.enable_btn()
     except Exception as e:
         for d in tmpdirs:
             try:
@@ -402,12 +422,14 @@ def build_apk_thread(game_dir, icon_path, package_name, app_name, ui_updater, pr
         ui_updater.show_error("Fehler", str(e))
         ui_updater.enable_btn()
     finally:
-        if original_java_home is not None:
-            os.environ['JAVA_HOME'] = original_java_home
-        else:
-            os.environ.pop('JAVA_HOME', None)
-        if original_path is not None:
-            os.environ['PATH'] = original_path
+        if meter is not None:
+            meter.stop()
+        if workspace is not None:
+            workspace.release()
+        if job_staging is not None:
+            job_staging.cleanup()
+        if reservation is not None:
+            reservation.release()
 
 def main():
     root = tk.Tk()
@@ -0,0 +1,357 @@
+"""JVM heap sizes from input size and RAM, and admission of builds by predicted peak RSS.
+
+Every build and tool run records its real peak RSS in cache/memory.sqlite,
+so predictions follow what builds on this machine actually use. Builds in
+other Kiridroid processes share the same file, which is also the ledger of
+the memory they have reserved.
+"""
+import ctypes
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+HISTORY_PATH = os.path.abspath(os.path.join("cache", "memory.sqlite"))
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+# Kinds of work that get a prediction. Inputs: apktool decode - base APK
+# size; apktool build - decoded tree size; apksigner - APK size; build -
+# game folder plus base APK.
+APKTOOL_DECODE = "apktool-decode"
+APKTOOL_BUILD = "apktool-build"
+APKSIGNER = "apksigner"
+BUILD = "build"
+# Peak RSS = base + ratio * input until there is history for the kind.
+DEFAULTS = {
+    APKTOOL_DECODE: (256 * MiB, 8.0),
+    APKTOOL_BUILD: (256 * MiB, 6.0),
+    BUILD: (768 * MiB, 0.25),
+}
+# apksigner streams the APK, so its memory does not grow with the input.
+FLAT_PEAKS = {
+    APKSIGNER: 384 * MiB,
+}
+# Predictions use the worst ratio of the last HISTORY_SAMPLES runs plus headroom.
+HISTORY_SAMPLES = 20
+HEADROOM = 1.25
+# Memory the JVM needs besides the heap: metaspace, code cache, thread stacks.
+JVM_OVERHEAD = 128 * MiB
+MIN_HEAP = 256 * MiB
+# No single JVM gets more than this share of physical memory.
+MAX_HEAP_FRACTION = 0.5
+# Share of physical memory that concurrent builds may reserve in total.
+BUDGET_FRACTION = 0.8
+ADMIT_POLL = 2.0
+SAMPLE_INTERVAL = 0.1
+
+# --- system memory ------------------------------------------------------------
+
+if sys.platform == "win32":
+    from ctypes import wintypes
+
+    class _MemoryStatusEx(ctypes.Structure):
+        _fields_ = [("dwLength", wintypes.DWORD), ("dwMemoryLoad", wintypes.DWORD),
+                    ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+    class _ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    _PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    _STILL_ACTIVE = 259
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _psapi = ctypes.WinDLL("psapi", use_last_error=True)
+    _kernel32.OpenProcess.restype = wintypes.HANDLE
+
+def physical_memory():
+    """Return (total, available) physical memory in bytes."""
+    if sys.platform == "win32":
+        status = _MemoryStatusEx()
+        status.dwLength = ctypes.sizeof(status)
+        _kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullTotalPhys, status.ullAvailPhys
+    try:
+        info = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                info[name] = int(value.split()[0]) * 1024
+        return info["MemTotal"], info.get("MemAvailable", info["MemFree"])
+    except (OSError, KeyError, ValueError):
+        page = os.sysconf("SC_PAGE_SIZE")
+        total = os.sysconf("SC_PHYS_PAGES") * page
+        try:
+            available = os.sysconf("SC_AVPHYS_PAGES") * page
+        except (ValueError, OSError):
+            available = total
+        return total, available
+
+def process_rss(pid):
+    """Resident set size of pid in bytes, 0 when it cannot be read."""
+    if sys.platform == "win32":
+        handle = _kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return 0
+        try:
+            counters = _ProcessMemoryCounters()
+            counters.cb = ctypes.sizeof(counters)
+            if not _psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return 0
+            return counters.WorkingSetSize
+        finally:
+            _kernel32.CloseHandle(handle)
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def pid_alive(pid):
+    if sys.platform == "win32":
+        handle = _kernel32.OpenProcess(_PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        try:
+            code = wintypes.DWORD()
+            return bool(_kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == _STILL_ACTIVE
+        finally:
+            _kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# --- peak sampling --------------------------------------------------------------
+
+# Tool processes a thread is running right now: pid -> (thread id, baseline
+# RSS). A warm daemon JVM is watched only for the run it serves, with the
+# RSS it already had as baseline.
+_watched = {}
+_watched_lock = threading.Lock()
+
+def watch(pid, baseline=0):
+    """Count pid towards the jobs of the calling thread, less baseline bytes."""
+    with _watched_lock:
+        _watched[pid] = (threading.get_ident(), baseline)
+
+def unwatch(pid):
+    with _watched_lock:
+        _watched.pop(pid, None)
+
+class PeakMonitor:
+    """Sample the tool processes watched by the creating thread and keep the peak.
+
+    include_self adds what this process grew by since the monitor started;
+    other builds in the process grow it too, so that part is an upper bound.
+    """
+
+    def __init__(self, include_self=True, interval=SAMPLE_INTERVAL):
+        self.include_self = include_self
+        self.interval = interval
+        self.owner = threading.get_ident()
+        self.baseline = process_rss(os.getpid()) if include_self else 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        with _watched_lock:
+            pids = [(pid, baseline) for pid, (owner, baseline) in _watched.items() if owner == self.owner]
+        total = sum(max(0, process_rss(pid) - baseline) for pid, baseline in pids)
+        if self.include_self:
+            total += max(0, process_rss(os.getpid()) - self.baseline)
+        self.peak = max(self.peak, total)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._loop, name="peak-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sample()
+        return self.peak
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+# --- history and predictions -------------------------------------------------------
+
+def _connect(path=HISTORY_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS samples (kind, input_bytes, peak_bytes, recorded REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS reservations (pid, kind, bytes, started REAL)")
+    return db
+
+def record(kind, input_bytes, peak_bytes):
+    """Store the real peak RSS of a run."""
+    if peak_bytes <= 0:
+        return
+    try:
+        db = _connect()
+        try:
+            db.execute("INSERT INTO samples VALUES (?, ?, ?, ?)", (kind, input_bytes, peak_bytes, time.time()))
+            db.execute("DELETE FROM samples WHERE kind = ? AND rowid NOT IN "
+                       "(SELECT rowid FROM samples WHERE kind = ? ORDER BY recorded DESC LIMIT ?)",
+                       (kind, kind, HISTORY_SAMPLES))
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not record memory use: {e}")
+        return
+    logging.info(f"Peak memory of {kind}: {peak_bytes / MiB:.0f} MiB for {input_bytes / MiB:.1f} MiB of input")
+
+def predict_peak(kind, input_bytes):
+    """Predicted peak RSS in bytes of running kind on input_bytes of input."""
+    if kind in FLAT_PEAKS:
+        return FLAT_PEAKS[kind]
+    base, ratio = DEFAULTS[kind]
+    try:
+        db = _connect()
+        try:
+            rows = db.execute("SELECT input_bytes, peak_bytes FROM samples WHERE kind = ? "
+                              "ORDER BY recorded DESC LIMIT ?", (kind, HISTORY_SAMPLES)).fetchall()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        logging.warning(f"Memory history unavailable: {e}")
+        rows = []
+    if rows:
+        # Small runs show the fixed base, larger ones how memory grows with input.
+        base = min(base, min(peak for _, peak in rows))
+        ratio = max((peak - base) / max(size, 1) for size, peak in rows)
+    return int((base + ratio * input_bytes) * HEADROOM)
+
+def heap_bytes(kind, input_bytes):
+    """-Xmx for a tool JVM: the predicted peak less JVM overhead, rounded up to a power of two."""
+    total, _ = physical_memory()
+    wanted = max(MIN_HEAP, predict_peak(kind, input_bytes) - JVM_OVERHEAD)
+    heap = MIN_HEAP
+    while heap < wanted:
+        heap *= 2
+    return max(MIN_HEAP, min(heap, int(total * MAX_HEAP_FRACTION) // MiB * MiB))
+
+def heap_args(kind, input_bytes):
+    return [f"-Xmx{heap_bytes(kind, input_bytes) // MiB}m"]
+
+def tree_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# --- admission -----------------------------------------------------------------------
+
+class Reservation:
+    """Memory held by an admitted build; release() records the build's real peak.
+
+    workers is the build's share of the CPUs next to the builds that were
+    running when it was admitted.
+    """
+
+    def __init__(self, kind, input_bytes, predicted, row, running=0):
+        self.kind = kind
+        self.input_bytes = input_bytes
+        self.predicted = predicted
+        self.row = row
+        self.workers = max(1, (os.cpu_count() or 1) // (running + 1))
+        self.monitor = PeakMonitor().start()
+
+    def release(self, record_peak=True):
+        if self.monitor is None:
+            return
+        peak = self.monitor.stop()
+        self.monitor = None
+        if self.row is not None:
+            try:
+                db = _connect()
+                try:
+                    db.execute("DELETE FROM reservations WHERE rowid = ?", (self.row,))
+                finally:
+                    db.close()
+            except sqlite3.Error as e:
+                logging.warning(f"Could not update the memory ledger: {e}")
+        if record_peak:
+            record(self.kind, self.input_bytes, peak)
+        logging.info(f"Build memory: predicted {self.predicted / MiB:.0f} MiB, peak {peak / MiB:.0f} MiB")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.release(record_peak=exc_type is None)
+
+def _try_admit(db, kind, predicted):
+    """Reserve predicted bytes if they fit; return the ledger row or None."""
+    total, available = physical_memory()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute("SELECT rowid, pid, bytes FROM reservations").fetchall()
+        dead = [(rowid,) for rowid, pid, _ in rows if not pid_alive(pid)]
+        db.executemany("DELETE FROM reservations WHERE rowid = ?", dead)
+        reserved = sum(size for rowid, _, size in rows if (rowid,) not in dead)
+        running = len(rows) - len(dead)
+        # A build always runs when nothing else does, however large its prediction.
+        fits = running == 0 or (reserved + predicted <= total * BUDGET_FRACTION and predicted <= available)
+        row = None
+        if fits:
+            row = db.execute("INSERT INTO reservations VALUES (?, ?, ?, ?)",
+                             (os.getpid(), kind, predicted, time.time())).lastrowid
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    return row, reserved, running
+
+def admit(kind, input_bytes, waiting=None):
+    """Block until the predicted peak of a build fits next to the builds already running.
+
+    waiting(predicted, reserved, running) is called while the build waits.
+    """
+    predicted = predict_peak(kind, input_bytes)
+    try:
+        db = _connect()
+    except sqlite3.Error as e:
+        logging.warning(f"Memory ledger unavailable, admitting without it: {e}")
+        return Reservation(kind, input_bytes, predicted, None)
+    try:
+        while True:
+            row, reserved, running = _try_admit(db, kind, predicted)
+            if row is not None:
+                break
+            if waiting is not None:
+                waiting(predicted, reserved, running)
+            time.sleep(ADMIT_POLL)
+    finally:
+        db.close()
+    reservation = Reservation(kind, input_bytes, predicted, row, running)
+    logging.info(f"Build admitted: predicted peak {predicted / MiB:.0f} MiB, "
+                 f"{reserved / MiB:.0f} MiB reserved by {running} other build(s), {reservation.workers} worker(s)")
+    return reservation
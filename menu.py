@@ -191,9 +191,9 @@ class MenuApp(tk.Tk):
         # 3. Launch script
         try:
             if sys.platform == 'win32':
-                subprocess.Popen([sys.executable, pyfile], shell=True)
+                subprocess.Popen([sys.executable, pyfile] + sys.argv[1:], shell=True)
             else:
-                subprocess.Popen([sys.executable, pyfile])
+                subprocess.Popen([sys.executable, pyfile] + sys.argv[1:])
         except Exception as e:
             play_sound('error.wav')
             messagebox.showerror("Launch failed", f"Failed to launch script: {e}")
@@ -202,4 +202,4 @@ class MenuApp(tk.Tk):
 
 if __name__ == "__main__":
     app = MenuApp()
-    app.mainloop() 
\ No newline at end of file
+    app.mainloop() 
\ No newline at end of file
@@ -0,0 +1,143 @@
+"""Per-entry STORED/DEFLATE decisions for game assets, with a savings report."""
+import logging
+import math
+import os
+import zipfile
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Same defaults as aapt: media that is already compressed is stored as-is.
+NO_COMPRESS_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".wav", ".mp2", ".mp3", ".ogg", ".aac",
+    ".mpg", ".mpeg", ".mid", ".midi", ".smf", ".jet", ".rtttl", ".imy", ".xmf",
+    ".mp4", ".m4a", ".m4v", ".3gp", ".3gpp", ".3g2", ".3gpp2", ".amr", ".awb",
+    ".wma", ".wmv", ".webm", ".mkv",
+}
+# Kirikiri formats that are already compressed. XP3 is stored so the runtime
+# can seek into the archive without inflating it first.
+STORE_EXTENSIONS = NO_COMPRESS_EXTENSIONS | {
+    ".xp3", ".tlg", ".webp", ".opus", ".flac", ".avi", ".zip", ".7z", ".rar", ".gz", ".bz2", ".xz",
+}
+DEFLATE_EXTENSIONS = {
+    ".ks", ".tjs", ".txt", ".csv", ".ini", ".xml", ".json", ".func", ".asd", ".sli",
+    ".ttf", ".otf", ".ttc", ".bmp",
+}
+
+SAMPLE_SIZE = 256 * 1024
+ENTROPY_STORE_THRESHOLD = 7.5
+TRIAL_STORE_RATIO = 0.95
+TRIAL_LEVEL = 1
+# How many files per extension are trial-compressed to estimate what storing
+# them forgoes; the rest get the mean ratio of those samples.
+ESTIMATE_SAMPLES = 8
+
+def byte_entropy(sample):
+    """Shannon entropy of a byte string in bits per byte."""
+    if not sample:
+        return 0.0
+    if numpy is not None:
+        counts = numpy.bincount(numpy.frombuffer(sample, dtype=numpy.uint8), minlength=256)
+        p = counts[counts > 0] / len(sample)
+        return float(-(p * numpy.log2(p)).sum())
+    n = len(sample)
+    entropy = 0.0
+    for b in range(256):
+        c = sample.count(bytes((b,)))
+        if c:
+            entropy -= c / n * math.log2(c / n)
+    return entropy
+
+def trial_ratio(sample):
+    if not sample:
+        return 1.0
+    return len(zlib.compress(sample, TRIAL_LEVEL)) / len(sample)
+
+def read_sample(path):
+    with open(path, "rb") as f:
+        return f.read(SAMPLE_SIZE)
+
+class Decision:
+    def __init__(self, compress_type, reason, ratio=None):
+        self.compress_type = compress_type
+        self.reason = reason
+        self.ratio = ratio
+
+class CompressionPolicy:
+    def __init__(self):
+        self.decisions = {}
+        self._ext_ratios = {}
+
+    def choose(self, arcname, path):
+        ext = os.path.splitext(arcname)[1].lower()
+        if ext not in STORE_EXTENSIONS and ext not in DEFLATE_EXTENSIONS:
+            # Aliases such as gameexe.dat -> data.xp3 follow their source file.
+            ext = os.path.splitext(path)[1].lower()
+        if ext in STORE_EXTENSIONS:
+            decision = Decision(zipfile.ZIP_STORED, "extension", self._estimate(ext, path))
+        elif ext in DEFLATE_EXTENSIONS:
+            decision = Decision(zipfile.ZIP_DEFLATED, "extension")
+        else:
+            sample = read_sample(path)
+            if not sample:
+                decision = Decision(zipfile.ZIP_STORED, "empty", 1.0)
+            elif byte_entropy(sample) >= ENTROPY_STORE_THRESHOLD:
+                decision = Decision(zipfile.ZIP_STORED, "entropy", trial_ratio(sample))
+            else:
+                ratio = trial_ratio(sample)
+                if ratio >= TRIAL_STORE_RATIO:
+                    decision = Decision(zipfile.ZIP_STORED, "trial", ratio)
+                else:
+                    decision = Decision(zipfile.ZIP_DEFLATED, "trial", ratio)
+        self.decisions[arcname] = decision
+        return decision.compress_type
+
+    def _estimate(self, ext, path):
+        """Deflate ratio of a file stored by extension: its own trial for the first
+        ESTIMATE_SAMPLES files of ext, the mean of those after."""
+        ratios = self._ext_ratios.setdefault(ext, [])
+        if len(ratios) < ESTIMATE_SAMPLES:
+            ratios.append(trial_ratio(read_sample(path)))
+            return ratios[-1]
+        return sum(ratios) / len(ratios)
+
+    def report(self, entries):
+        """Log bytes saved by deflating and bytes forgone by storing, per extension.
+
+        The delta column is what deflate saved (negative where it grew an
+        entry) or, for stored entries, minus the estimated saving forgone.
+        """
+        rows = {}
+        saved = overhead = forgone = 0
+        for entry in entries:
+            decision = self.decisions.get(entry.name)
+            if decision is None:
+                continue
+            ext = os.path.splitext(entry.name)[1].lower() or "(none)"
+            method = "deflate" if decision.compress_type == zipfile.ZIP_DEFLATED else "store"
+            row = rows.setdefault((method, decision.reason, ext), [0, 0, 0, 0])
+            row[0] += 1
+            row[1] += entry.file_size
+            row[2] += entry.compress_size
+            if method == "deflate":
+                gain = entry.file_size - entry.compress_size
+                row[3] += gain
+                if gain >= 0:
+                    saved += gain
+                else:
+                    overhead -= gain
+            else:
+                ratio = 1.0 if decision.ratio is None else decision.ratio
+                lost = int(entry.file_size * max(0.0, 1.0 - ratio))
+                row[3] -= lost
+                forgone += lost
+        lines = [f"{'method':8} {'reason':9} {'ext':8} {'files':>7} {'bytes':>14} {'packed':>14} {'delta':>14}"]
+        for (method, reason, ext), (files, size, packed, delta) in sorted(rows.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"{method:8} {reason:9} {ext:8} {files:7d} {size:14d} {packed:14d} {delta:+14d}")
+        lines.append(f"deflate saved {saved} bytes and added {overhead} bytes to entries it could not shrink; "
+                     f"storing forwent an estimated {forgone} bytes")
+        logging.info("Compression report:\n" + "\n".join(lines))
+        return rows
@@ -0,0 +1,66 @@
+"""Patch the Kirikiroid2 app shell directly inside the base APK, without apktool."""
+import io
+import logging
+import re
+import struct
+import zipfile
+
+from PIL import Image
+
+import arsc
+import axml
+
+ICON_ENTRY = re.compile(r"^res/drawable-(mdpi|hdpi|xhdpi|xxhdpi)(-v4)?/ic_launcher\.png$")
+
+class ShellPatchError(Exception):
+    pass
+
+def resize_icon(user_icon, original_png):
+    with Image.open(io.BytesIO(original_png)) as orig_icon:
+        size = orig_icon.size
+    out = io.BytesIO()
+    user_icon.resize(size, Image.LANCZOS).save(out, format="PNG")
+    return out.getvalue()
+
+def patch_label(zf, manifest, app_name):
+    """Rewrite the string resources the manifest labels point at.
+
+    Returns {"resources.arsc": new bytes}, or {} when the labels have to be
+    written into the manifest as literals instead.
+    """
+    label_ids = axml.label_references(manifest)
+    if not label_ids or "resources.arsc" not in zf.namelist():
+        return {}
+    try:
+        table = arsc.set_string_resources(zf.read("resources.arsc"), label_ids, app_name)
+    except (arsc.ArscError, struct.error, IndexError, UnicodeError) as e:
+        logging.info(f"resources.arsc label edit not possible, using a literal label: {e}")
+        return {}
+    logging.info(f"Relabelled {len(label_ids)} string resources in resources.arsc")
+    return {"resources.arsc": table}
+
+def direct_shell_overrides(base_apk, icon_path, package_name, app_name):
+    """Return {entry name: new bytes} for the manifest and launcher icons.
+
+    Raises ShellPatchError when the base APK cannot be patched in binary form,
+    in which case the caller falls back to the apktool round trip.
+    """
+    with zipfile.ZipFile(base_apk) as zf:
+        names = zf.namelist()
+        if "AndroidManifest.xml" not in names:
+            raise ShellPatchError("Base APK has no AndroidManifest.xml")
+        icon_names = [name for name in names if ICON_ENTRY.match(name)]
+        if not icon_names:
+            raise ShellPatchError("No res/drawable-*/ic_launcher.png entries in the base APK")
+        overrides = {}
+        try:
+            manifest = zf.read("AndroidManifest.xml")
+            overrides.update(patch_label(zf, manifest, app_name))
+            overrides["AndroidManifest.xml"] = axml.patch_manifest(
+                manifest, package_name, app_name, keep_label_references="resources.arsc" in overrides)
+        except (axml.AxmlError, struct.error, IndexError, UnicodeError) as e:
+            raise ShellPatchError(f"Binary manifest patch failed: {e}") from e
+        user_icon = Image.open(icon_path).convert("RGBA")
+        for name in icon_names:
+            overrides[name] = resize_icon(user_icon, zf.read(name))
+    return overrides
@@ -0,0 +1,64 @@
+"""Per-job staging folders on the scratch volume.
+
+A build writes and checks its APK in its own staging folder and publishes
+it with one os.replace, so other builds and readers of the output folder
+never see a partial file. When the staging folder is on another volume the
+APK is first copied into a staging folder next to the output. Cleanup
+removes the job's own folders and nothing else.
+"""
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+import fastcopy
+import memplan
+
+STAGING_NAME = ".staging"
+
+def _sweep(root):
+    # Folders are named <pid>-...; those of processes that are gone were left by a crash.
+    for name in os.listdir(root):
+        pid = name.split("-", 1)[0]
+        if pid.isdigit() and int(pid) != os.getpid() and not memplan.pid_alive(int(pid)):
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            logging.info(f"Removed staging folder of an exited build: {name}")
+
+def _job_dir(volume_dir):
+    root = os.path.join(volume_dir, STAGING_NAME)
+    os.makedirs(root, exist_ok=True)
+    _sweep(root)
+    return tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=root)
+
+class JobStaging:
+    """Staging for one job under scratch_root, the output folder by default."""
+
+    def __init__(self, output_dir, scratch_root=None):
+        self.path = _job_dir(scratch_root or output_dir)
+        self._landing = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def publish(self, staged, final_path):
+        """Move a staged file to final_path in one step, replacing an older output."""
+        try:
+            os.replace(staged, final_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            if self._landing is None:
+                self._landing = _job_dir(os.path.dirname(final_path))
+            landing = os.path.join(self._landing, os.path.basename(final_path))
+            method = fastcopy.copy_file(staged, landing, allow_link=False)
+            os.remove(staged)
+            os.replace(landing, final_path)
+            logging.info(f"Copied {staged} to the output volume ({method})")
+        logging.info(f"Published {final_path}")
+        return final_path
+
+    def cleanup(self):
+        for path in (self.path, self._landing):
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
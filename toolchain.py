@@ -0,0 +1,29 @@
+"""Tool paths and subprocess environment for one build job.
+
+Builds used to point JAVA_HOME and PATH of the whole process at the bundled
+JDK, so two builds in one process overwrote each other's settings. A
+Toolchain is resolved per job instead and hands every subprocess an
+explicit env.
+"""
+import os
+import shutil
+import subprocess
+
+class Toolchain:
+    def __init__(self, java_bin, apktool_jar, apksigner=None, base_env=None):
+        self.java_bin = os.path.abspath(java_bin)
+        self.java_home = os.path.dirname(os.path.dirname(self.java_bin))
+        self.apktool_jar = apktool_jar
+        self.apksigner = apksigner
+        env = dict(os.environ if base_env is None else base_env)
+        env["JAVA_HOME"] = self.java_home
+        env["PATH"] = os.path.join(self.java_home, "bin") + os.pathsep + env.get("PATH", "")
+        self.env = env
+
+    def which(self, name):
+        """Path of a program on this toolchain's PATH (the bundled JDK first), or name itself."""
+        # subprocess looks programs up on the parent's PATH, not on env's.
+        return shutil.which(name, path=self.env["PATH"]) or name
+
+    def run(self, cmd, **kwargs):
+        return subprocess.run(cmd, env=self.env, **kwargs)
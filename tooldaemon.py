@@ -0,0 +1,306 @@
+"""Run apktool and apksigner in long-lived JVMs (ToolDaemon.java), falling back to one-shot java.
+
+A daemon runs one tool at a time (System.out is global in the JVM), so each
+call takes a daemon no other call is using: concurrent builds get a daemon
+each, up to MAX_DAEMONS, and past that run one-shot instead of queueing.
+A daemon keeps the environment it was started with, so only calls with the
+same env share one.
+"""
+import atexit
+import logging
+import os
+import re
+import secrets
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import appcds
+import memplan
+
+DAEMON_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ToolDaemon.java")
+STATE_DIR = os.path.abspath(os.path.join("cache", "tooldaemon"))
+# The daemon exits by itself after this many idle seconds.
+IDLE_TIMEOUT = 600
+START_TIMEOUT = 60
+PING_TIMEOUT = 5
+# Long enough for the JVM to write its AppCDS archive on the way out.
+SHUTDOWN_TIMEOUT = 30
+# Daemons alive at once, busy or idle; idle ones exit after IDLE_TIMEOUT.
+MAX_DAEMONS = 4
+# Once the daemon could not be started, builds in this process stop trying.
+ENABLED = True
+
+class ToolDaemonError(Exception):
+    pass
+
+def _send(sock, value):
+    data = value.encode("utf-8")
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1024 * 1024))
+        if not chunk:
+            raise ToolDaemonError("Daemon closed the connection")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+class ToolDaemon:
+    def __init__(self, java_bin, jvm_args=(), env=None, idle_timeout=IDLE_TIMEOUT):
+        self.java_bin = java_bin
+        self.jvm_args = list(jvm_args)
+        self.env = env
+        self.env_key = _env_key(env)
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.port = None
+        self.token = None
+        self.start_failed = False
+        self.active = 0
+        self.retired = False
+        self.lock = threading.Lock()
+
+    def _archive_flags(self, jar):
+        """AppCDS flags for the daemon; the archive is keyed on the JDK, this source and the first tool jar."""
+        if not appcds.supported(self.java_bin):
+            return [], None
+        try:
+            archive = appcds.archive_path(self.java_bin, DAEMON_SOURCE, jar)
+        except OSError as e:
+            logging.warning(f"AppCDS disabled for the tool daemon: {e}")
+            return [], None
+        if not os.path.exists(archive):
+            appcds.remove_stale(archive)
+        return appcds.archive_flags(archive), archive
+
+    def _start(self, jar):
+        os.makedirs(STATE_DIR, exist_ok=True)
+        port_file = os.path.join(STATE_DIR, f"{os.getpid()}-{id(self)}.port")
+        if os.path.exists(port_file):
+            os.remove(port_file)
+        self.token = secrets.token_hex(16)
+        cds_flags, archive = self._archive_flags(jar)
+        with_archive = archive is not None and os.path.exists(archive)
+        cmd = [self.java_bin, *self.jvm_args, *cds_flags, "-Djava.security.manager=allow", DAEMON_SOURCE,
+               port_file, str(self.idle_timeout)]
+        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
+        started = time.perf_counter()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, env=self.env, creationflags=creationflags)
+        # The token goes over stdin: anyone on the machine can read a command line.
+        try:
+            self.process.stdin.write(self.token.encode("ascii") + b"\n")
+            self.process.stdin.close()
+        except OSError as e:
+            self.process.kill()
+            raise ToolDaemonError(f"Could not hand the daemon its token: {e}") from e
+        while not os.path.exists(port_file):
+            if self.process.poll() is not None:
+                raise ToolDaemonError(f"Daemon exited during startup with code {self.process.returncode}")
+            if time.perf_counter() - started > START_TIMEOUT:
+                self.process.kill()
+                raise ToolDaemonError("Daemon did not start in time")
+            time.sleep(0.05)
+        with open(port_file, encoding="utf-8") as f:
+            self.port = int(f.readline())
+        os.remove(port_file)
+        logging.info(f"Tool daemon started (pid {self.process.pid}, port {self.port}) "
+                     f"in {time.perf_counter() - started:.2f}s {'with' if with_archive else 'without'} AppCDS archive")
+
+    def _request(self, command, args=(), timeout=None):
+        try:
+            with socket.create_connection(("127.0.0.1", self.port), timeout=PING_TIMEOUT) as sock:
+                sock.settimeout(timeout)
+                _send(sock, self.token)
+                _send(sock, command)
+                sock.sendall(struct.pack(">I", len(args)))
+                for arg in args:
+                    _send(sock, arg)
+                code, = struct.unpack(">i", _recv_exact(sock, 4))
+                stdout = _recv_exact(sock, struct.unpack(">I", _recv_exact(sock, 4))[0])
+                stderr = _recv_exact(sock, struct.unpack(">I", _recv_exact(sock, 4))[0])
+        except OSError as e:
+            raise ToolDaemonError(f"Daemon request failed: {e}") from e
+        return code, stdout, stderr
+
+    def alive(self):
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            code, _, _ = self._request("ping", timeout=PING_TIMEOUT)
+        except ToolDaemonError:
+            return False
+        return code == 0
+
+    def ensure_running(self, jar):
+        """Start the daemon unless it is up; returns True when this call started it."""
+        with self.lock:
+            if self.alive():
+                return False
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+            try:
+                self._start(jar)
+            except (OSError, ToolDaemonError):
+                self.start_failed = True
+                raise
+            return True
+
+    def run(self, jar, args, timeout=None):
+        """Run a tool jar; the caller holds the daemon (see acquire)."""
+        try:
+            started = self.ensure_running(jar)
+            pid = self.process.pid
+            # The memory a warm daemon kept from earlier runs is not this run's.
+            memplan.watch(pid, 0 if started else memplan.process_rss(pid))
+            try:
+                return self._request("run", [os.path.abspath(jar), *args], timeout)
+            finally:
+                memplan.unwatch(pid)
+        except ToolDaemonError:
+            # The tool may still be running in there; start a fresh daemon next time.
+            with self.lock:
+                if self.process is not None:
+                    self.process.kill()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            idle_retired = self.retired and not self.active
+        if idle_retired:
+            self.shutdown()
+
+    def retire(self):
+        """Shut down once the requests in flight (from other builds) are done."""
+        with self.lock:
+            self.retired = True
+            idle = not self.active
+        if idle:
+            self.shutdown()
+
+    def shutdown(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self._request("shutdown", timeout=PING_TIMEOUT)
+                    self.process.wait(timeout=SHUTDOWN_TIMEOUT)
+                except (ToolDaemonError, subprocess.TimeoutExpired):
+                    self.process.kill()
+            self.process = None
+
+_daemons = []
+_daemons_lock = threading.Lock()
+
+def _heap_of(jvm_args):
+    """Return (-Xmx in bytes or None, the other JVM arguments)."""
+    heap = None
+    others = []
+    for arg in jvm_args:
+        match = re.fullmatch(r"-Xmx(\d+)([kKmMgG]?)", arg)
+        if match:
+            heap = int(match.group(1)) * {"": 1, "k": 1024, "m": memplan.MiB, "g": memplan.GiB}[match.group(2).lower()]
+        else:
+            others.append(arg)
+    return heap, tuple(others)
+
+def _env_key(env):
+    return tuple(sorted((os.environ if env is None else env).items()))
+
+def acquire(java_bin, jvm_args=(), env=None):
+    """Take an idle daemon for java_bin, the JVM options and env, or None when all are busy.
+
+    A daemon whose heap is at least the requested -Xmx is reused; idle ones
+    with a smaller heap are retired. release() hands the daemon back.
+    """
+    heap, others = _heap_of(jvm_args)
+    env_key = _env_key(env)
+    retired = []
+    with _daemons_lock:
+        daemon = None
+        for candidate in _daemons:
+            if candidate.java_bin != java_bin or candidate.env_key != env_key or candidate.active:
+                continue
+            daemon_heap, daemon_others = _heap_of(candidate.jvm_args)
+            if daemon_others != others:
+                continue
+            if heap is None or (daemon_heap or 0) >= heap:
+                daemon = candidate
+                break
+            retired.append(candidate)
+        if daemon is None and len(_daemons) - len(retired) >= MAX_DAEMONS:
+            # Make room by dropping an idle daemon set up for other options or another env.
+            idle = [d for d in _daemons if not d.active and d not in retired]
+            retired += idle[:1]
+        for old in retired:
+            _daemons.remove(old)
+        if daemon is None and len(_daemons) < MAX_DAEMONS:
+            daemon = ToolDaemon(java_bin, jvm_args, None if env is None else dict(env))
+            _daemons.append(daemon)
+        if daemon is not None:
+            with daemon.lock:
+                daemon.active += 1
+    for old in retired:
+        old.retire()
+    return daemon
+
+@atexit.register
+def shutdown_all():
+    for daemon in list(_daemons):
+        daemon.shutdown()
+
+def _split_java_command(cmd):
+    """Return (java, jvm args, jar, tool args) for [java, ..., "-jar", jar, ...], else None."""
+    if "-jar" not in cmd:
+        return None
+    i = cmd.index("-jar")
+    if i + 1 >= len(cmd) or any("\n" in arg for arg in cmd):
+        return None
+    return cmd[0], cmd[1:i], cmd[i + 1], cmd[i + 2:]
+
+def run_java(cmd, text=False, timeout=None, kind=None, input_bytes=0, env=None):
+    """Drop-in for subprocess.run(cmd, capture_output=True) on a "java ... -jar tool.jar" command.
+
+    The tool runs inside the shared daemon JVM; if the daemon cannot be
+    started or fails mid-request, the command is run one-shot instead.
+    A failed request only costs a restart next time, a failed start
+    disables the daemon for the rest of the process. When every daemon is
+    busy with other builds, the command runs one-shot as well. With kind, the peak
+    RSS of the tool JVM is recorded for memplan's predictions.
+    """
+    if kind is None:
+        return _run_java(cmd, text, timeout, env)
+    with memplan.PeakMonitor(include_self=False) as monitor:
+        result = _run_java(cmd, text, timeout, env)
+    memplan.record(kind, input_bytes, monitor.peak)
+    return result
+
+def _run_java(cmd, text, timeout, env):
+    global ENABLED
+    parts = _split_java_command(cmd)
+    if ENABLED and parts is not None:
+        java_bin, jvm_args, jar, args = parts
+        daemon = acquire(java_bin, jvm_args, env)
+        if daemon is None:
+            logging.info(f"All {MAX_DAEMONS} tool daemons are busy, running one-shot")
+        else:
+            try:
+                code, stdout, stderr = daemon.run(jar, args, timeout)
+            except (OSError, ToolDaemonError) as e:
+                logging.warning(f"Tool daemon unavailable, running one-shot: {e}")
+                if daemon.start_failed:
+                    ENABLED = False
+            else:
+                if text:
+                    stdout = stdout.decode("utf-8", errors="replace")
+                    stderr = stderr.decode("utf-8", errors="replace")
+                return subprocess.CompletedProcess(cmd, code, stdout, stderr)
+            finally:
+                daemon.release()
+    return appcds.run(cmd, text=text, timeout=timeout, env=env)